@@ -0,0 +1,349 @@
+'''
+Build step and runtime support for fingerprinted static assets. The build
+copies every file under static/ to static/dist/ with a hash of its content
+in the name, so its URL changes whenever the file does and browsers can
+cache it forever. Text files get gzip and brotli copies, JPG and PNG
+images get resized JPG, WebP and AVIF variants for srcset, and the
+animated case GIFs of the epidemic simulator get animated WebP and MP4
+copies. Everything is recorded in static/dist/manifest.json.
+
+At runtime, init_app makes url_for('static', filename=...) point at the
+fingerprinted copy, serves the dist folder with immutable far-future
+cache headers and precompressed bodies, and adds srcset() and picture()
+to the templates. Without a manifest, static files are served as before.
+
+Build from the website folder (Pillow and ffmpeg are optional, variants
+they make are skipped without them):
+    python assets.py
+'''
+import argparse
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import posixpath
+import re
+import shutil
+import subprocess
+import sys
+from markupsafe import Markup, escape
+from flask import current_app, request, send_from_directory, url_for
+
+try:
+    import brotli
+except ImportError:  # no brotli copies
+    brotli = None
+
+DIST = 'dist'
+MANIFEST = 'manifest.json'
+# Files and folders under static/ that are not served
+SKIP_DIRS = {DIST, '__pycache__', 'node_modules', 'scss'}
+SKIP_FILES = {'package.json', 'package-lock.json', 'gulpfile.js'}
+SKIP_SUFFIXES = {'.py', '.pyc', '.php', '.partial'}
+COMPRESSIBLE = {'.css', '.js', '.svg', '.html', '.json', '.xml', '.txt',
+                '.webmanifest', '.map', '.ttf', '.eot', '.otf', '.ico'}
+# Pillow format of the images given resized variants
+RESPONSIVE = {'.jpg': 'JPEG', '.jpeg': 'JPEG', '.png': 'PNG'}
+# Widths of the resized variants, only those below the original are made
+WIDTHS = (320, 640, 1024, 1600)
+# Folder of the animated GIFs turned into animated WebP and MP4
+ANIMATED = 'epidemic/images/cases'
+# Cache lifetime of fingerprinted files
+MAX_AGE = 365 * 24 * 3600
+
+_CSS_URL = re.compile(r'''url\(\s*(['"]?)([^'")]+)\1\s*\)''')
+
+
+def fingerprint(path, digest):
+    '''img/a.jpg -> img/a.<digest>.jpg'''
+    root, ext = posixpath.splitext(path)
+    return f'{root}.{digest}{ext}'
+
+
+def _digest(data):
+    return hashlib.sha256(data).hexdigest()[:12]
+
+
+def _sources(static):
+    '''Relative paths of the files to publish, css files last'''
+    paths = []
+    for root, dirs, names in os.walk(static):
+        dirs[:] = sorted(d for d in dirs if d not in SKIP_DIRS)
+        for name in sorted(names):
+            if (name in SKIP_FILES or name.startswith('.')
+                    or posixpath.splitext(name)[1].lower() in SKIP_SUFFIXES):
+                continue
+            path = os.path.relpath(os.path.join(root, name), static)
+            paths.append(path.replace(os.sep, '/'))
+    # css files point at fonts and images, which are renamed first
+    return sorted(paths, key=lambda path: path.lower().endswith('.css'))
+
+
+def _rewrite_css(data, path, files):
+    '''Points the url()s of a css file at the fingerprinted files'''
+    folder = posixpath.dirname(path)
+
+    def replace(match):
+        target, suffix = re.match(r'([^?#]*)(.*)', match.group(2)).groups()
+        if re.match(r'^([a-z]+:|/|data:)', target, re.I):
+            return match.group(0)
+        source = posixpath.normpath(posixpath.join(folder, target))
+        if source not in files:
+            return match.group(0)
+        relative = posixpath.relpath(files[source]['file'], folder)
+        return f'url({match.group(1)}{relative}{suffix}{match.group(1)})'
+    return _CSS_URL.sub(replace, data.decode('utf-8')).encode('utf-8')
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(path + '.tmp', path)
+
+
+def build_assets(static='static', log=print):
+    '''
+    Publishes every file under static to static/dist and writes the
+    manifest. Files already published with the same content are kept, so
+    rebuilding only processes what changed. Returns the manifest.
+    '''
+    dist = os.path.join(static, DIST)
+    files = {}
+    for path in _sources(static):
+        with open(os.path.join(static, path), 'rb') as f:
+            data = f.read()
+        ext = posixpath.splitext(path)[1].lower()
+        if ext == '.css':
+            data = _rewrite_css(data, path, files)
+        digest = _digest(data)
+        entry = {'file': fingerprint(path, digest)}
+        target = os.path.join(dist, entry['file'])
+        if not os.path.exists(target):
+            _write(target, data)
+            log(f'{path} -> {entry["file"]}')
+        if ext in COMPRESSIBLE:
+            entry['encodings'] = _precompress(target, data)
+        if ext in RESPONSIVE:
+            entry.update(_resized(os.path.join(static, path), path, digest,
+                                  dist, log))
+        if ext == '.gif' and posixpath.dirname(path) == ANIMATED:
+            entry.update(_animated(os.path.join(static, path), path, digest,
+                                   dist, log))
+        files[path] = entry
+
+    manifest = {'version': 1, 'files': files}
+    _write(os.path.join(dist, MANIFEST),
+           json.dumps(manifest, indent=1, sort_keys=True).encode('utf-8'))
+    return manifest
+
+
+def _precompress(target, data):
+    '''Writes gzip and brotli copies next to target, returns encodings'''
+    encodings = []
+    compressors = [('br', '.br', brotli and (lambda d: brotli.compress(d))),
+                   ('gzip', '.gz', lambda d: gzip.compress(d, 9, mtime=0))]
+    for encoding, suffix, compress in compressors:
+        if compress is None:
+            continue
+        if not os.path.exists(target + suffix):
+            compressed = compress(data)
+            if len(compressed) >= len(data):
+                continue
+            _write(target + suffix, compressed)
+        encodings.append(encoding)
+    return encodings
+
+
+def _resized(source, path, digest, dist, log):
+    '''
+    Resized JPG (or PNG), WebP and AVIF variants of an image as
+    {"width": original width, "variants": {format: {width: file}}}
+    '''
+    try:
+        from PIL import Image, features
+    except ImportError:
+        return {}
+    root, ext = posixpath.splitext(fingerprint(path, digest))
+    formats = {ext.lstrip('.').lower(): RESPONSIVE[ext.lower()],
+               'webp': 'WEBP'}
+    if features.check('avif'):
+        formats['avif'] = 'AVIF'
+    variants = {name: {} for name in formats}
+    # the image is only decoded when a variant is missing
+    with Image.open(source) as image:
+        width, height = image.size
+        for size in [w for w in WIDTHS if w < width] + [width]:
+            resized = None
+            for name, fmt in formats.items():
+                file = f'{root}.{size}.{name}'
+                target = os.path.join(dist, file)
+                if not os.path.exists(target):
+                    if resized is None:
+                        resized = image.resize(
+                            (size, max(1, round(height * size / width))),
+                            Image.LANCZOS)
+                        if resized.mode not in ('RGB', 'RGBA'):
+                            resized = resized.convert(
+                                'RGBA' if 'A' in resized.getbands()
+                                else 'RGB')
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    (resized.convert('RGB') if fmt == 'JPEG' else
+                     resized).save(target, fmt, quality=80)
+                    log(f'{path} -> {file}')
+                variants[name][str(size)] = file
+    return {'width': width, 'variants': variants}
+
+
+def _animated(source, path, digest, dist, log):
+    '''Animated WebP and, with ffmpeg, MP4 copies of an animated GIF'''
+    copies = {}
+    root = posixpath.splitext(fingerprint(path, digest))[0]
+    try:
+        from PIL import Image
+    except ImportError:
+        Image = None
+    if Image is not None:
+        file = f'{root}.webp'
+        target = os.path.join(dist, file)
+        if not os.path.exists(target):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with Image.open(source) as image:
+                image.save(target, 'WEBP', save_all=True, quality=75,
+                           method=4)
+            log(f'{path} -> {file}')
+        copies['webp'] = file
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg is not None:
+        file = f'{root}.mp4'
+        target = os.path.join(dist, file)
+        if not os.path.exists(target):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            # even dimensions and yuv420p so every browser can play it
+            subprocess.run([ffmpeg, '-loglevel', 'error', '-y', '-i', source,
+                            '-movflags', 'faststart', '-pix_fmt', 'yuv420p',
+                            '-vf', 'scale=trunc(iw/2)*2:trunc(ih/2)*2',
+                            target], check=True)
+            log(f'{path} -> {file}')
+        copies['mp4'] = file
+    return {'animated': copies} if copies else {}
+
+
+def load_manifest(static):
+    '''Files of the manifest in static/dist, empty without a build'''
+    try:
+        with open(os.path.join(static, DIST, MANIFEST),
+                  encoding='utf-8') as f:
+            return json.load(f)['files']
+    except FileNotFoundError:
+        return {}
+
+
+def init_app(app):
+    '''
+    Serves fingerprinted assets when static/dist holds a manifest. Reads
+    the manifest once, at startup.
+    '''
+    files = load_manifest(app.static_folder)
+    app.extensions['assets'] = files
+    if not files:
+        app.jinja_env.globals.update(srcset=lambda *a, **k: '',
+                                     picture=_plain_picture)
+        return
+
+    @app.url_defaults
+    def fingerprinted(endpoint, values):
+        if endpoint == 'static':
+            entry = files.get(values.get('filename'))
+            if entry is not None:
+                values['filename'] = f'{DIST}/{entry["file"]}'
+
+    static_view = app.view_functions['static']
+
+    def static(filename):
+        if not filename.startswith(DIST + '/'):
+            return static_view(filename=filename)
+        return _send_dist(app, filename)
+
+    app.view_functions['static'] = static
+    app.jinja_env.globals.update(srcset=srcset, picture=picture)
+
+
+def _send_dist(app, filename):
+    '''A fingerprinted file, precompressed if the client accepts it'''
+    accepted = request.accept_encodings
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if accepted[encoding] and os.path.exists(
+                os.path.join(app.static_folder, filename + suffix)):
+            response = send_from_directory(app.static_folder,
+                                           filename + suffix,
+                                           mimetype=mimetype, max_age=MAX_AGE)
+            response.content_encoding = encoding
+            break
+    else:
+        response = send_from_directory(app.static_folder, filename,
+                                       max_age=MAX_AGE)
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+def srcset(filename, fmt=None):
+    '''
+    srcset attribute value listing the resized variants of an image in a
+    format (its own by default), empty when there are none
+    '''
+    entry = current_app.extensions['assets'].get(filename, {})
+    variants = entry.get('variants', {})
+    if fmt is None:
+        fmt = posixpath.splitext(filename)[1].lstrip('.').lower()
+    return ', '.join(
+        f'{url_for("static", filename=f"{DIST}/{file}")} {width}w'
+        for width, file in sorted(variants.get(fmt, {}).items(),
+                                  key=lambda item: int(item[0])))
+
+
+def picture(filename, alt='', sizes='100vw', **attrs):
+    '''
+    <picture> of an image with AVIF and WebP sources and a srcset of its
+    own format, a plain <img> when no variants were built
+    '''
+    entry = current_app.extensions['assets'].get(filename, {})
+    if not entry.get('variants'):
+        return _plain_picture(filename, alt, sizes, **attrs)
+    sources = [f'<source type="image/{fmt}" srcset="{srcset(filename, fmt)}"'
+               f' sizes="{escape(sizes)}">'
+               for fmt in ('avif', 'webp') if fmt in entry['variants']]
+    img = _img(filename, alt, srcset=srcset(filename), sizes=sizes, **attrs)
+    return Markup('<picture>' + ''.join(sources) + img + '</picture>')
+
+
+def _plain_picture(filename, alt='', sizes='100vw', **attrs):
+    return Markup(_img(filename, alt, **attrs))
+
+
+def _img(filename, alt, **attrs):
+    attrs = {'class' if name == 'class_' else name: value
+             for name, value in attrs.items() if value is not None}
+    rendered = ''.join(f' {name}="{escape(value)}"'
+                       for name, value in attrs.items())
+    return (f'<img src="{url_for("static", filename=filename)}"'
+            f' alt="{escape(alt)}"{rendered}>')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Fingerprint, compress and resize the files under '
+        'static/ into static/dist with a manifest for the website.')
+    parser.add_argument('--static', default='static',
+                        help='static folder (default static)')
+    parser.add_argument('--quiet', action='store_true',
+                        help='do not list the files written')
+    args = parser.parse_args()
+    built = build_assets(args.static, log=(lambda *a: None) if args.quiet
+                         else print)
+    print(f'{len(built["files"])} files in '
+          f'{os.path.join(args.static, DIST, MANIFEST)}', file=sys.stderr)
@@ -0,0 +1,163 @@
+'''
+Reproducible benchmarks of the cash back engine. Times process_data,
+calc_temp_cb and calc_cb for every number of cards, BOA tier and
+membership setting, and calc_cb_all for all numbers of cards at once, on
+seeded random spend profiles and on the realistic profiles in
+benchmarks/profiles.csv.
+
+Run from the website folder:
+    python -m benchmarks.bench_cashback                  # print results
+    python -m benchmarks.bench_cashback --save           # new baseline
+    python -m benchmarks.bench_cashback --compare        # fail on slowdowns
+'''
+import argparse
+import csv
+import json
+import os
+import platform
+import sys
+import time
+import numpy as np
+from cb.cashback import process_data, calc_cb, calc_cb_all, calc_temp_cb
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BASELINE = os.path.join(HERE, 'baseline.json')
+FIXTURE = os.path.join(HERE, 'profiles.csv')
+
+CARD_COUNTS = range(1, 9)
+BOA_TIERS = (1, 1.75)
+MEMBERS = {'none': {'amazon_member': False, 'costco_member': False,
+                    'sams_member': False},
+           'all': {'amazon_member': True, 'costco_member': True,
+                   'sams_member': True}}
+
+
+def random_profiles(count, seed, num_categories=17):
+    '''
+    Seeded spend profiles: each category is skipped with probability 0.4,
+    otherwise its monthly spend is log-normal around $100
+    '''
+    rng = np.random.default_rng(seed)
+    spend = rng.lognormal(np.log(100), 1, (count, num_categories))
+    spend[rng.random((count, num_categories)) < 0.4] = 0
+    return np.round(spend, 2)
+
+
+def fixture_profiles(path=FIXTURE):
+    '''Realistic spend profiles checked in with the benchmarks'''
+    with open(path, newline='') as f:
+        return np.array([[float(v) for v in row.values()]
+                         for row in csv.DictReader(f)])
+
+
+def timings(function, args_list):
+    '''Seconds taken by function for each set of arguments'''
+    elapsed = []
+    for args in args_list:
+        start = time.perf_counter()
+        function(*args)
+        elapsed.append(time.perf_counter() - start)
+    return np.array(elapsed)
+
+
+def summary(elapsed):
+    '''Latency percentiles in milliseconds and calls per second'''
+    p50, p95, p99 = np.percentile(elapsed, [50, 95, 99]) * 1000
+    return {'p50_ms': round(p50, 4), 'p95_ms': round(p95, 4),
+            'p99_ms': round(p99, 4), 'n': len(elapsed),
+            'per_second': round(len(elapsed) / elapsed.sum(), 1)}
+
+
+def run(num_profiles, seed, card_counts=CARD_COUNTS):
+    '''Benchmarks every configuration and returns results by name'''
+    profiles = np.vstack([random_profiles(num_profiles, seed),
+                          fixture_profiles()])
+    results = {}
+    for tier in BOA_TIERS:
+        results[f'process_data/boa={tier}'] = summary(
+            timings(process_data, [(tier,)] * 5))
+        catalog = process_data(tier)
+        comb_dict, card_vectors, card_names = catalog
+
+        rng = np.random.default_rng(seed)
+        combos = [tuple(rng.choice(len(card_names), 3, replace=False))
+                  for _ in range(50)]
+        results[f'calc_temp_cb/boa={tier}'] = summary(timings(
+            calc_temp_cb, [(card_vectors, profiles[i % len(profiles)],
+                            combo, 3, MEMBERS['none'])
+                           for i, combo in enumerate(combos)]))
+
+        for num_cards in card_counts:
+            for members, attr in MEMBERS.items():
+                args = [(comb_dict, num_cards, card_vectors, card_names,
+                         spend, attr) for spend in profiles]
+                calc_cb(*args[0])  # build cached candidate tables first
+                name = f'calc_cb/cards={num_cards}/boa={tier}/' \
+                    f'members={members}'
+                results[name] = summary(timings(calc_cb, args))
+                print(f'{name:45} {results[name]["p50_ms"]:10.3f} ms p50',
+                      file=sys.stderr)
+        results[f'calc_cb_all/boa={tier}'] = summary(timings(
+            calc_cb_all, [(comb_dict, max(card_counts), card_vectors,
+                           card_names, spend, MEMBERS['none'])
+                          for spend in profiles]))
+    return results
+
+
+def compare(results, baseline, threshold):
+    '''
+    Names of configurations whose median latency grew by more than
+    threshold (a fraction) over the baseline
+    '''
+    slower = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before and result['p50_ms'] > before['p50_ms'] * (1 + threshold):
+            slower.append(name)
+            print(f'SLOWER {name}: {before["p50_ms"]:.3f} -> '
+                  f'{result["p50_ms"]:.3f} ms p50')
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--profiles', type=int, default=40,
+                        help='random profiles per configuration, on top of '
+                        'the fixture (default 40)')
+    parser.add_argument('--seed', type=int, default=2020)
+    parser.add_argument('--cards', type=int, nargs='+',
+                        default=list(CARD_COUNTS),
+                        help='numbers of cards to benchmark (default 1-8)')
+    parser.add_argument('--save', nargs='?', const=BASELINE,
+                        metavar='FILE', help='write results as a baseline')
+    parser.add_argument('--compare', nargs='?', const=BASELINE,
+                        metavar='FILE', help='compare with a baseline')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='allowed slowdown before --compare fails '
+                        '(default 0.25 = 25%%)')
+    args = parser.parse_args()
+
+    results = run(args.profiles, args.seed, args.cards)
+    for name, result in results.items():
+        print(f'{name:45} p50 {result["p50_ms"]:9.3f}  '
+              f'p95 {result["p95_ms"]:9.3f}  p99 {result["p99_ms"]:9.3f} ms'
+              f'  {result["per_second"]:10.1f}/s')
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'python': platform.python_version(),
+                       'numpy': np.__version__, 'seed': args.seed,
+                       'profiles': args.profiles, 'results': results},
+                      f, indent=2, sort_keys=True)
+            f.write('\n')
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+        print(f'No configuration slower than {args.threshold:.0%} '
+              'over the baseline')
+
+
+if __name__ == '__main__':
+    main()
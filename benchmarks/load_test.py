@@ -0,0 +1,307 @@
+'''
+Open-loop load generator for the website. Replays a weighted mix of page
+GETs and /cashback form submissions, with spend profiles and numbers of
+cards varied per request, at fixed target rates, against a running
+server or the app in process through the Flask test client. Requests are
+sent on schedule whether or not earlier ones have finished, and latency
+is measured from the scheduled time, so a saturated server shows up as
+growing latency instead of a lower request rate.
+
+Each client thread fetches /cashback once for its session cookie and CSRF
+token and posts the form with it, fetching a new token if it is refused.
+
+Run from the website folder:
+    python -m benchmarks.load_test --rates 10 50 100       # in process
+    python -m benchmarks.load_test --url http://127.0.0.1:8000
+    python -m benchmarks.load_test --save                  # new baseline
+    python -m benchmarks.load_test --compare               # fail if worse
+'''
+import argparse
+import http.cookiejar
+import json
+import os
+import platform
+import re
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from benchmarks.bench_cashback import fixture_profiles, random_profiles
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BASELINE = os.path.join(HERE, 'load_baseline.json')
+
+# route -> weight, 'cashback' posts the form, anything else is a GET path
+MIX = {'/': 3, '/resume': 1, '/blog': 1, '/projects': 1,
+       '/epidemic/epidemic': 1, 'cashback': 4}
+CARD_COUNTS = (1, 2, 3, 4, 5, 8)
+# Form fields of the 16 spend categories, in the order of spend arrays
+SPEND_FIELDS = ('groceries', 'gas', 'restaurants', 'entertainment',
+                'travel', 'utilities', 'cell_carrier', 'gym',
+                'online_shopping', 'amazon', 'home_improvement', 'internet',
+                'sporting_goods', 'apple', 'foreign_transaction',
+                'rideshare')
+
+_CSRF = re.compile(rb'name="csrf_token" type="hidden" value="([^"]+)"')
+
+
+class InProcess:
+    '''Sends requests to the app through one test client per thread'''
+
+    def __init__(self, app):
+        self.app = app
+        self._local = threading.local()
+
+    def request(self, method, path, data=None):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        response = client.open(path, method=method, data=data)
+        return response.status_code, response.get_data()
+
+
+class Http:
+    '''Sends requests to a server, with one cookie jar per thread'''
+
+    def __init__(self, url, timeout=30):
+        self.url, self.timeout = url.rstrip('/'), timeout
+        self._local = threading.local()
+
+    def request(self, method, path, data=None):
+        opener = getattr(self._local, 'opener', None)
+        if opener is None:
+            opener = self._local.opener = urllib.request.build_opener(
+                urllib.request.HTTPCookieProcessor(
+                    http.cookiejar.CookieJar()))
+        body = urllib.parse.urlencode(data).encode() if data else None
+        request = urllib.request.Request(self.url + path, body,
+                                         method=method)
+        try:
+            with opener.open(request, timeout=self.timeout) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+
+class Replay:
+    '''
+    The requests of a load test. Keeps the CSRF token of every thread's
+    session and turns spend profiles into /cashback form submissions.
+    '''
+
+    def __init__(self, target, mix, profiles, card_counts, seed):
+        self.target = target
+        self.routes = list(mix)
+        weights = np.array([mix[route] for route in self.routes], float)
+        self.weights = weights / weights.sum()
+        self.profiles, self.card_counts = profiles, card_counts
+        self.rng = np.random.default_rng(seed)
+        self._local = threading.local()
+
+    def next_request(self):
+        '''Route and form data of a random request, None for GETs'''
+        route = self.routes[self.rng.choice(len(self.routes),
+                                            p=self.weights)]
+        if route != 'cashback':
+            return route, None
+        spend = self.profiles[self.rng.integers(len(self.profiles))]
+        form = {field: f'{value:.2f}'
+                for field, value in zip(SPEND_FIELDS, spend)}
+        form['total'] = f'{spend.sum():.2f}'
+        form['num_cards'] = str(self.rng.choice(self.card_counts))
+        return route, form
+
+    def send(self, route, form):
+        '''Sends one request and returns its status code'''
+        if form is None:
+            return self.target.request('GET', route)[0]
+        for attempt in range(2):
+            token = getattr(self._local, 'token', None)
+            if token is None or attempt:
+                token = self._local.token = self._token()
+            status, body = self.target.request(
+                'POST', '/cashback', {**form, 'csrf_token': token})
+            # a refused token renders the form again without results
+            if status != 200 or b'per year in cash back' in body:
+                return status
+        return 400
+
+    def _token(self):
+        _, body = self.target.request('GET', '/cashback')
+        match = _CSRF.search(body)
+        return match.group(1).decode() if match else ''
+
+
+def run_step(replay, rate, duration, concurrency, poisson=False):
+    '''
+    Sends requests at rate per second for duration seconds and returns
+    (route, status, latency in seconds) of every request and the seconds
+    until the last one finished
+    '''
+    count = max(int(rate * duration), 1)
+    gaps = (replay.rng.exponential(1 / rate, count) if poisson
+            else np.full(count, 1 / rate))
+    schedule = np.concatenate([[0], np.cumsum(gaps[:-1])])
+    records, lock = [], threading.Lock()
+
+    def send(route, form, scheduled):
+        try:
+            status = replay.send(route, form)
+        except Exception:
+            status = 0  # connection errors and timeouts
+        latency = time.perf_counter() - scheduled
+        with lock:
+            records.append((route, status, latency))
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        start = time.perf_counter()
+        for offset in schedule:
+            delay = start + offset - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            route, form = replay.next_request()
+            executor.submit(send, route, form, start + offset)
+    return records, time.perf_counter() - start
+
+
+def summary(records, elapsed):
+    '''
+    Throughput, latency percentiles in milliseconds and error rates of
+    the records of one route. 503 answers count as shed, other 4xx and 5xx
+    answers and failed connections as errors.
+    '''
+    statuses = np.array([status for _, status, _ in records])
+    latency = np.array([latency for _, _, latency in records])
+    ok = (statuses > 0) & (statuses < 400)
+    p50, p95, p99 = np.percentile(latency, [50, 95, 99]) * 1000
+    return {'n': len(records), 'per_second': round(ok.sum() / elapsed, 2),
+            'p50_ms': round(p50, 3), 'p95_ms': round(p95, 3),
+            'p99_ms': round(p99, 3),
+            'error_rate': round(float(np.mean(~ok & (statuses != 503))), 4),
+            'shed_rate': round(float(np.mean(statuses == 503)), 4)}
+
+
+def run(replay, rates, duration, concurrency, poisson=False):
+    '''Runs every rate in turn and returns results by rate and route'''
+    results = {}
+    for rate in rates:
+        records, elapsed = run_step(replay, rate, duration, concurrency,
+                                    poisson)
+        by_route = defaultdict(list)
+        for record in records:
+            by_route[record[0]].append(record)
+        by_route['all'] = records
+        for route, route_records in sorted(by_route.items()):
+            name = f'{rate:g}/s {route}'
+            results[name] = summary(route_records, elapsed)
+            print(f'{name:35} {results[name]["per_second"]:8.1f}/s  '
+                  f'p50 {results[name]["p50_ms"]:9.1f}  '
+                  f'p95 {results[name]["p95_ms"]:9.1f}  '
+                  f'p99 {results[name]["p99_ms"]:9.1f} ms  '
+                  f'errors {results[name]["error_rate"]:6.1%}  '
+                  f'shed {results[name]["shed_rate"]:6.1%}')
+    return results
+
+
+def compare(results, baseline, threshold):
+    '''
+    Names of results whose p95 latency grew or throughput fell by more
+    than threshold (a fraction), or whose error or shed rate grew by more
+    than a point, over the baseline
+    '''
+    worse = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if not before:
+            continue
+        reasons = []
+        if result['p95_ms'] > before['p95_ms'] * (1 + threshold):
+            reasons.append(f'p95 {before["p95_ms"]:.1f} -> '
+                           f'{result["p95_ms"]:.1f} ms')
+        if result['per_second'] < before['per_second'] * (1 - threshold):
+            reasons.append(f'{before["per_second"]:.1f} -> '
+                           f'{result["per_second"]:.1f}/s')
+        for rate in ('error_rate', 'shed_rate'):
+            if result[rate] > before[rate] + 0.01:
+                reasons.append(f'{rate} {before[rate]:.1%} -> '
+                               f'{result[rate]:.1%}')
+        if reasons:
+            worse.append(name)
+            print(f'WORSE {name}: {", ".join(reasons)}')
+    return worse
+
+
+def parse_mix(text):
+    '''"/:3,cashback:1" -> {"/": 3.0, "cashback": 1.0}'''
+    mix = {}
+    for item in text.split(','):
+        route, _, weight = item.strip().rpartition(':')
+        mix[route] = float(weight)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--url', help='server to load, e.g. '
+                        'http://127.0.0.1:8000 (default: the app in '
+                        'process)')
+    parser.add_argument('--rates', type=float, nargs='+', default=[10, 25],
+                        help='target requests per second, one step each '
+                        '(default 10 25)')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds per rate (default 10)')
+    parser.add_argument('--concurrency', type=int, default=64,
+                        help='most requests in flight (default 64)')
+    parser.add_argument('--mix', type=parse_mix,
+                        default=MIX, help='weighted routes, e.g. '
+                        '"/:3,/resume:1,cashback:4" where cashback posts '
+                        'the form')
+    parser.add_argument('--cards', type=int, nargs='+',
+                        default=list(CARD_COUNTS),
+                        help='numbers of cards of the form posts')
+    parser.add_argument('--poisson', action='store_true',
+                        help='random arrivals instead of evenly spaced')
+    parser.add_argument('--seed', type=int, default=2020)
+    parser.add_argument('--save', nargs='?', const=BASELINE,
+                        metavar='FILE', help='write results as a baseline')
+    parser.add_argument('--compare', nargs='?', const=BASELINE,
+                        metavar='FILE', help='compare with a baseline')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='allowed change before --compare fails '
+                        '(default 0.25 = 25%%)')
+    args = parser.parse_args()
+
+    if args.url:
+        target = Http(args.url)
+    else:
+        from flaskblog import create_app
+        target = InProcess(create_app(warm=True))
+    profiles = np.vstack([random_profiles(200, args.seed),
+                          fixture_profiles()])
+    replay = Replay(target, args.mix, profiles, args.cards, args.seed)
+    results = run(replay, args.rates, args.duration, args.concurrency,
+                  args.poisson)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'python': platform.python_version(),
+                       'target': args.url or 'in process',
+                       'seed': args.seed, 'duration': args.duration,
+                       'mix': args.mix, 'results': results},
+                      f, indent=2, sort_keys=True)
+            f.write('\n')
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+        print(f'Nothing worse than {args.threshold:.0%} over the baseline')
+
+
+if __name__ == '__main__':
+    main()
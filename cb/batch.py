@@ -0,0 +1,244 @@
+'''
+Scores many spend profiles at once for the batch JSON API and the batch
+mode of cashback.py. Profiles are grouped by BOA tier and number of cards
+so each group is scored against the catalog in one vectorized pass
+instead of one calc_cb call each.
+
+A profile is a dictionary like
+    {"spend": [...], "attr": {"amazon_member": true, ...},
+     "num_cards": 2, "boa_amt": 25000, "top": 3}
+where spend is the monthly spend array built by
+CreditCardForm.get_spend_attr (16 categories followed by other spend).
+The optional top asks for that many ranked combinations in "ranked".
+'''
+import csv
+import json
+import math
+import multiprocessing
+import os
+import sys
+import time
+from collections import defaultdict, deque
+from itertools import islice
+import numpy as np
+from cb.cashback import (calc_cb_batch, calc_cb_top, calc_stats,
+                         get_boa_multiplier)
+from cb.catalog import CatalogCache
+
+MEMBER_KEYS = ('amazon_member', 'costco_member', 'sams_member')
+MAX_CARDS = 8
+MAX_TOP = 10
+
+# Catalog of the current process when streaming, see _init_worker
+_worker_catalog = None
+
+
+def parse_batch(body, ndjson=False):
+    '''
+    Splits a request body holding a JSON array, or one JSON object per
+    line for NDJSON, into a list of profiles. Raises ValueError if the body
+    is not valid JSON.
+    '''
+    if ndjson:
+        return [json.loads(line) for line in body.splitlines()
+                if line.strip()]
+    items = json.loads(body)
+    if not isinstance(items, list):
+        raise ValueError('Expected a JSON array of spend profiles')
+    return items
+
+
+def parse_profile(item, num_categories):
+    '''
+    Validates one profile and returns (spend, attr, num_cards,
+    boa_multiplier, top), top being 0 when no ranking was asked for.
+    Raises ValueError with a message for the caller.
+    '''
+    if not isinstance(item, dict):
+        raise ValueError('Profile must be a JSON object')
+    try:
+        spend = np.array(item['spend'], dtype=np.float64)
+    except (KeyError, TypeError, ValueError):
+        raise ValueError('spend must be a list of numbers')
+    if spend.shape != (num_categories,) or not np.isfinite(spend).all():
+        raise ValueError(f'spend must have {num_categories} finite values')
+
+    attr = item.get('attr') or {}
+    if not isinstance(attr, dict):
+        raise ValueError('attr must be a JSON object')
+    attr = {key: bool(attr.get(key, False)) for key in MEMBER_KEYS}
+
+    num_cards = item.get('num_cards', 1)
+    if (not isinstance(num_cards, int) or isinstance(num_cards, bool)
+            or not 1 <= num_cards <= MAX_CARDS):
+        raise ValueError(f'num_cards must be an integer from 1 to {MAX_CARDS}')
+
+    boa_amt = item.get('boa_amt') or 0
+    if not isinstance(boa_amt, (int, float)) or isinstance(boa_amt, bool):
+        raise ValueError('boa_amt must be a number')
+
+    top = item.get('top') or 0
+    if (not isinstance(top, int) or isinstance(top, bool)
+            or not 0 <= top <= MAX_TOP):
+        raise ValueError(f'top must be an integer from 0 to {MAX_TOP}')
+    return (np.round(spend, 2), attr, num_cards,
+            get_boa_multiplier(boa_amt), top)
+
+
+def searched(item):
+    '''
+    Whether a profile, valid or not, asks for more than 3 cards: those are
+    searched one profile at a time instead of in one vectorized pass
+    '''
+    num_cards = item.get('num_cards', 1) if isinstance(item, dict) else 1
+    return (isinstance(num_cards, int) and not isinstance(num_cards, bool)
+            and num_cards > 3)
+
+
+def score_profiles(items, catalog):
+    '''
+    Best combination and cash back statistics for every profile, in input
+    order, with the ranked combinations of profiles asking for them.
+    Invalid profiles get {"error": message} instead.
+    '''
+    num_categories = len(catalog.get(1)[1].categories)
+    results = [None] * len(items)
+    groups, ranked = defaultdict(list), []
+    for i, item in enumerate(items):
+        try:
+            spend, attr, num_cards, mult, top = parse_profile(
+                item, num_categories)
+        except ValueError as e:
+            results[i] = {'error': str(e)}
+            continue
+        groups[mult, num_cards].append((i, spend, attr))
+        if top:
+            ranked.append((i, spend, attr, num_cards, mult, top))
+
+    for (mult, num_cards), profiles in groups.items():
+        comb_dict, card_vectors, card_names = catalog.get(mult)
+        index, spends, attrs = zip(*profiles)
+        scored = calc_cb_batch(comb_dict, num_cards, card_vectors,
+                               card_names, np.array(spends), list(attrs))
+        for i, spend, result in zip(index, spends, scored):
+            results[i] = result_dict(spend, *result)
+
+    for i, spend, attr, num_cards, mult, top in ranked:
+        comb_dict, card_vectors, card_names = catalog.get(mult)
+        results[i]['ranked'] = [
+            result_dict(spend, *result) for result in calc_cb_top(
+                comb_dict, num_cards, card_vectors, card_names, spend, attr,
+                top)]
+    return results
+
+
+def result_dict(spend, max_cb, best_combo, member_rec, select_cat):
+    '''JSON friendly result of one profile'''
+    with np.errstate(divide='ignore', invalid='ignore'):  # no spend
+        avg_cb, annual_cb = calc_stats(spend, max_cb)
+    avg_cb = float(avg_cb)
+    return {'best_combo': [int(card) for card in best_combo],
+            'max_cb': float(max_cb),
+            'avg_cb': avg_cb if math.isfinite(avg_cb) else None,
+            'annual_cb': float(annual_cb),
+            'member_rec': member_rec, 'select_cat': select_cat}
+
+
+def read_profiles(stream, fmt):
+    '''
+    Lazily yields profiles from an open csv or jsonl stream. A csv file
+    has one column per spend category (named as in card_data.csv), plus
+    amazon_member, costco_member, sams_member, num_cards and boa_amt.
+    Missing values count as 0. Lines of a jsonl file that are not valid
+    JSON are passed on as text and reported as invalid profiles.
+    '''
+    if fmt == 'jsonl':
+        for line in stream:
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    yield line.strip()
+        return
+    for row in csv.DictReader(stream):
+        yield _csv_profile(row)
+
+
+def _csv_profile(row):
+    '''Converts a csv row into the dictionary form of a profile'''
+    def number(value, convert=float):
+        try:
+            return convert(value) if value not in (None, '') else 0
+        except ValueError:
+            return value  # rejected by parse_profile
+    spend = [number(row.get(category)) for category in _categories()]
+    attr = {key: str(row.get(key, '')).strip().lower()
+            in ('1', 'true', 'y', 'yes') for key in MEMBER_KEYS}
+    return {'spend': spend, 'attr': attr,
+            'num_cards': number(row.get('num_cards') or 1, int),
+            'boa_amt': number(row.get('boa_amt'))}
+
+
+def _categories():
+    return _worker_catalog.get(1)[1].categories
+
+
+def _init_worker(path):
+    '''Builds the catalog once per process'''
+    global _worker_catalog
+    _worker_catalog = CatalogCache(path)
+    _worker_catalog.load()
+
+
+def _score_chunk(items):
+    return score_profiles(items, _worker_catalog)
+
+
+def run_batch(infile, outfile, fmt, chunk_size=10000, workers=1,
+              path='card_data.csv'):
+    '''
+    Streams profiles from infile to one JSON result per line in outfile,
+    chunk_size profiles at a time so memory stays constant. With more than
+    one worker, chunks are scored in a process pool, keeping at most two
+    chunks per worker in flight, and written in input order. Prints a
+    throughput summary to stderr and returns the number of invalid
+    profiles. workers=0 uses every core.
+    '''
+    workers = workers or os.cpu_count()
+    _init_worker(path)  # csv column names, and scoring without a pool
+    start = time.perf_counter()
+    num_profiles, num_errors = 0, 0
+
+    def write(results):
+        nonlocal num_profiles, num_errors
+        for result in results:
+            outfile.write(json.dumps(result) + '\n')
+            num_errors += 'error' in result
+        num_profiles += len(results)
+
+    chunks = _chunks(read_profiles(infile, fmt), chunk_size)
+    if workers == 1:
+        for chunk in chunks:
+            write(_score_chunk(chunk))
+    else:
+        with multiprocessing.Pool(workers, _init_worker, (path,)) as pool:
+            pending = deque()
+            for chunk in chunks:
+                pending.append(pool.apply_async(_score_chunk, (chunk,)))
+                if len(pending) >= 2 * workers:
+                    write(pending.popleft().get())
+            while pending:
+                write(pending.popleft().get())
+
+    elapsed = time.perf_counter() - start
+    print(f'Scored {num_profiles} profiles ({num_errors} invalid) in '
+          f'{elapsed:.2f}s, {num_profiles / max(elapsed, 1e-9):,.0f} '
+          'profiles/s', file=sys.stderr)
+    return num_errors
+
+
+def _chunks(items, size):
+    chunk = list(islice(items, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(items, size))
@@ -0,0 +1,178 @@
+'''
+Precompiled binary card catalog. Compiles card_data.csv, its rule table
+card_rules.csv and the card details of cb/data.csv (annual fees, spend
+caps, foreign transaction fees and signup bonuses) into one versioned file
+that every web worker maps into memory, so workers start without parsing
+csv files and share the same physical pages.
+
+File layout (little-endian):
+    8 bytes   magic b'CBCATLG\\0'
+    4 bytes   format version
+    4 bytes   length of the header
+    header    utf-8 JSON with names, comb_dict, the memberships, the choice
+              cards of each tier, the card details, a digest of the csv
+              files and the offset, shape and dtype of each array
+    arrays    raw C-ordered arrays, each aligned to 64 bytes
+
+Build it from the website folder with
+    python -m cb.binary_catalog [--csv card_data.csv] [--data cb/data.csv]
+                                [--output card_catalog.bin]
+'''
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import struct
+import numpy as np
+from cb.cards import BOA_TIERS, CardCatalog, ChoiceCard, read_card_details
+from cb.cashback import DETAILS_PATH, default_rules_path, process_data
+
+MAGIC = b'CBCATLG\0'
+FORMAT_VERSION = 4
+ALIGNMENT = 64
+_PREFIX = struct.Struct('<8sII')
+
+
+def file_digest(path):
+    '''sha256 of a file, used to tell whether a binary catalog is stale'''
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def source_digest(csv_path, data_path=DETAILS_PATH):
+    '''Digest of a card data csv file, its rule table and card details'''
+    return (file_digest(csv_path) + file_digest(default_rules_path(csv_path))
+            + file_digest(data_path))
+
+
+def build_binary_catalog(csv_path='card_data.csv', data_path=DETAILS_PATH,
+                         output='card_catalog.bin', tiers=None):
+    '''
+    Processes the catalog for every BOA tier and writes it to output.
+    The file is written next to output first and then moved into place, so
+    running workers never map a half written file.
+    '''
+    tiers = tuple(tiers or BOA_TIERS)
+    arrays, catalogs = [], {}
+    for tier in tiers:
+        comb_dict, card_vectors, card_names = process_data(
+            tier, csv_path, details_path=data_path)
+        catalogs[tier] = comb_dict, card_vectors, card_names
+        for name in ('rates', 'fees', 'members', 'divisors', 'limits'):
+            arrays.append((f'{name}/{tier!r}', getattr(card_vectors, name)))
+
+    comb_dict, card_vectors, card_names = catalogs[tiers[0]]
+    header = {'format': FORMAT_VERSION,
+              'source_digest': source_digest(csv_path, data_path),
+              'tiers': list(tiers),
+              'categories': list(card_vectors.categories),
+              'card_names': list(card_names),
+              'memberships': [list(m) for m in card_vectors.memberships],
+              'comb_dict': {name: [int(row) for row in rows]
+                            for name, rows in comb_dict.items()},
+              'choices': {repr(tier): [choice.to_dict() for choice
+                                       in catalogs[tier][1].choices]
+                          for tier in tiers},
+              'card_details': read_card_details(data_path),
+              'arrays': {}}
+
+    # Array offsets are relative to the aligned end of the header
+    offset = 0
+    for name, array in arrays:
+        header['arrays'][name] = {'offset': offset, 'shape': array.shape,
+                                  'dtype': array.dtype.str}
+        offset += _aligned(array.nbytes)
+    encoded = json.dumps(header, sort_keys=True).encode('utf-8')
+    data_start = _aligned(_PREFIX.size + len(encoded))
+
+    temp = output + '.tmp'
+    with open(temp, 'wb') as f:
+        f.write(_PREFIX.pack(MAGIC, FORMAT_VERSION, len(encoded)))
+        f.write(encoded)
+        for name, array in arrays:
+            f.seek(data_start + header['arrays'][name]['offset'])
+            f.write(np.ascontiguousarray(array).tobytes())
+        f.truncate(data_start + offset)
+    os.replace(temp, output)
+    return header
+
+
+def read_header(path):
+    '''
+    Header of a binary catalog and the offset of its first array. Raises
+    ValueError if path is not a binary catalog of this format version.
+    '''
+    with open(path, 'rb') as f:
+        prefix = f.read(_PREFIX.size)
+        if len(prefix) < _PREFIX.size:
+            raise ValueError(f'{path} is not a binary card catalog')
+        magic, version, length = _PREFIX.unpack(prefix)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a binary card catalog')
+        if version != FORMAT_VERSION:
+            raise ValueError(f'{path} has format {version}, '
+                             f'expected {FORMAT_VERSION}')
+        header = json.loads(f.read(length).decode('utf-8'))
+    return header, _aligned(_PREFIX.size + length)
+
+
+def _aligned(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def is_current(path, csv_path, data_path=DETAILS_PATH):
+    '''
+    Whether path is a readable binary catalog built from csv_path and the
+    card details in data_path
+    '''
+    try:
+        return read_header(path)[0]['source_digest'] == \
+            source_digest(csv_path, data_path)
+    except (OSError, ValueError):
+        return False
+
+
+def load_binary_catalog(path):
+    '''
+    Maps a binary catalog into memory and returns {tier: (comb_dict,
+    card_vectors, card_names)} like process_data. The arrays are read-only
+    views of the mapped file, nothing is copied.
+    '''
+    header, data_start = read_header(path)
+    with open(path, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def array(name):
+        spec = header['arrays'][name]
+        dtype = np.dtype(spec['dtype'])
+        count = int(np.prod(spec['shape']))
+        return np.frombuffer(buffer, dtype, count, data_start
+                             + spec['offset']).reshape(spec['shape'])
+
+    card_names = list(header['card_names'])
+    entries = {}
+    for tier in header['tiers']:
+        card_vectors = CardCatalog.from_arrays(
+            array(f'rates/{tier!r}'), header['categories'], card_names,
+            array(f'fees/{tier!r}'), array(f'members/{tier!r}'),
+            array(f'divisors/{tier!r}'), header['memberships'],
+            [ChoiceCard(**choice) for choice in header['choices'][repr(tier)]],
+            array(f'limits/{tier!r}'))
+        comb_dict = {name: list(rows)
+                     for name, rows in header['comb_dict'].items()}
+        entries[tier] = comb_dict, card_vectors, list(card_names)
+    return entries
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compile the card catalog into a binary file')
+    parser.add_argument('--csv', default='card_data.csv')
+    parser.add_argument('--data', default='cb/data.csv')
+    parser.add_argument('--output', default='card_catalog.bin')
+    args = parser.parse_args()
+    header = build_binary_catalog(args.csv, args.data, args.output)
+    print(f'Wrote {args.output}: {len(header["card_names"])} card rows, '
+          f'{len(header["categories"])} categories, '
+          f'BOA tiers {header["tiers"]}')
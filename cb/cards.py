@@ -0,0 +1,327 @@
+'''
+Compact, array backed card catalog used by the cash back engine. Holds the
+processed reward rates of every card row in one contiguous float64 matrix
+together with the category and card names and the fee, membership and
+rotating category vectors compiled from the rule table (card_rules.csv)
+and the monthly spend limits of capped rewards from cb/data.csv, so
+scoring never touches pandas and no card is special cased in code.
+'''
+import csv
+import re
+from itertools import combinations
+import numpy as np
+from cb.dominance import dominators
+
+# Multipliers returned by get_boa_multiplier
+BOA_TIERS = (1, 1.25, 1.5, 1.75)
+
+# Columns of the rule table, see read_rules
+RULE_COLUMNS = ('Card_ID', 'Annual_Fee', 'Membership', 'Membership_Cost',
+                'Membership_Rec', 'Rotating_Divisor', 'Choose', 'Choice_Key',
+                'Image', 'BOA_Tiers')
+
+# Rule of cards missing from the rule table
+NO_RULE = {'fee': 0.0, 'membership': None, 'divisor': 0.0, 'choose': 0,
+           'choice_key': '', 'image': '', 'boa_tiers': False}
+
+# Categories of cb/data.csv -> columns of card_data.csv they stand for,
+# compared in lower case with underscores as spaces
+DETAIL_COLUMNS = {
+    'groceries': ('grocery',), 'gas': ('gas',),
+    'gas (via exxon speedpass)': ('gas',), 'dining': ('dining',),
+    'restaurants': ('dining',), 'entertainment': ('entertainment',),
+    'travel': ('travel',), 'utilities': ('utilities',),
+    'cell phone': ('cell phone carrier',),
+    'gym/fitness center': ('gym/fitness',),
+    'online shopping': ('online shopping',), 'amazon': ('amazon',),
+    'amazon (inc. whole foods)': ('amazon',),
+    'home improvement': ('home improvement',),
+    'internet+streaming': ('cable/satellite', 'internet/cable/streaming'),
+    'streaming subscriptions': ('cable/satellite',
+                                'internet/cable/streaming'),
+    'sporting goods': ('sporting good stores',), 'apple': ('apple store',),
+    'ground transportation': ('rideshare',), 'rideshare': ('rideshare',)}
+
+# Months in the period of a spend limit like '$7,000/year'
+PERIOD_MONTHS = {'year': 12, 'yr': 12, 'quarter': 3, 'qtr': 3, 'month': 1,
+                 'mo': 1}
+
+_LIMIT = re.compile(r'\$\s*([\d,]+(?:\.\d+)?)\s*/\s*([a-z]+)', re.I)
+_INCLUDED = re.compile(r'Included in "([^"]+)"')
+
+
+def read_rules(path):
+    '''
+    Reads the rule table of the cards in card_data.csv, one row per
+    Card_ID. Cards without a row earn their rates with no fees or
+    memberships. A rule has
+        fee: float       : annual fee
+        membership: tuple: (attr key, annual cost, member_rec key) of the
+                           membership the card needs, or None
+        divisor: float   : rotating categories earn their rate one in
+                           divisor quarters, 0 for fixed categories
+        choose: int      : number of categories the user picks, 0 when the
+                           card has fixed categories
+        choice_key: str  : key of the picked categories in select_cat
+        image: str       : id of the card image and url of choice cards
+        boa_tiers: bool  : whether the BOA multiplier applies to the card
+    Raises ValueError for a malformed table.
+    '''
+    rules = {}
+    with open(path, newline='', encoding='utf-8') as f:
+        reader = csv.DictReader(f)
+        missing = set(RULE_COLUMNS) - set(reader.fieldnames or ())
+        if missing:
+            raise ValueError(f'{path} is missing columns {sorted(missing)}')
+        for line, row in enumerate(reader, 2):
+            try:
+                card_id = int(row['Card_ID'])
+                membership = None
+                if row['Membership'].strip():
+                    membership = (row['Membership'].strip(),
+                                  float(row['Membership_Cost']),
+                                  row['Membership_Rec'].strip())
+                rules[card_id] = {
+                    'fee': float(row['Annual_Fee'] or 0),
+                    'membership': membership,
+                    'divisor': float(row['Rotating_Divisor'] or 0),
+                    'choose': int(row['Choose'] or 0),
+                    'choice_key': row['Choice_Key'].strip(),
+                    'image': row['Image'].strip(),
+                    'boa_tiers': row['BOA_Tiers'].strip() in ('1', 'true')}
+            except (TypeError, ValueError) as e:
+                raise ValueError(f'{path} line {line}: {e}')
+    return rules
+
+
+def _money(value):
+    '''Parses '$1,000 ' or 'Free' into a number, None when empty'''
+    value = (value or '').strip().replace('$', '').replace(',', '')
+    if not value:
+        return None
+    if value.lower() == 'free':
+        return 0.0
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def _percent(value):
+    value = (value or '').strip().rstrip('%')
+    try:
+        return float(value) / 100
+    except ValueError:
+        return None
+
+
+def read_card_details(path):
+    '''
+    Card details from cb/data.csv by card name: annual fee, foreign
+    transaction fee, signup bonus with its spend requirement and time
+    period, and the spend limit of each reward category as written.
+    '''
+    details = {}
+    with open(path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            card = details.setdefault(row['Card Name'].strip(), {
+                'annual_fee': _money(row['Price (annually)']),
+                'ftf': _percent(row['FTF']),
+                'signup_bonus': _money(row['Signup Bonus']),
+                'spend_requirement': _money(row['Spend Requirement']),
+                'bonus_months': _money(row['Time Period (mo)']),
+                'caps': {}})
+            card['caps'][row['Category'].strip()] = \
+                row['Category Rewards Spend Limit'].strip()
+    return details
+
+
+def monthly_limit(text):
+    '''
+    Monthly spend of a limit as written in cb/data.csv, e.g. 500 for
+    '$1500/quarter', None when the text names no limit ('Limitless')
+    '''
+    match = _LIMIT.search(text or '')
+    if match is None or match.group(2).lower() not in PERIOD_MONTHS:
+        return None
+    return (float(match.group(1).replace(',', ''))
+            / PERIOD_MONTHS[match.group(2).lower()])
+
+
+def card_caps(details, categories):
+    '''
+    Spend limits of every card of read_card_details, as {card name:
+    [(columns, monthly limit, combined)]} for the columns of categories
+    they apply to. Categories written with the same limit share an entry;
+    combined limits are shared by their categories, the others apply to
+    each of them. A limit 'Included in' another category is that one's.
+    '''
+    column_of = {name.lower().replace('_', ' '): i
+                 for i, name in enumerate(categories)}
+    caps = {}
+    for name, card in details.items():
+        groups = {}  # limit as written -> columns
+        for category, text in card['caps'].items():
+            included = _INCLUDED.search(text)
+            if included:
+                text = card['caps'].get(included.group(1), '')
+            if monthly_limit(text) is None:
+                continue
+            groups.setdefault(text, []).extend(
+                column_of[column]
+                for column in DETAIL_COLUMNS.get(category.lower(), ())
+                if column in column_of)
+        caps[name] = [(tuple(columns), monthly_limit(text),
+                       'combined' in text.lower())
+                      for text, columns in groups.items() if columns]
+    return caps
+
+
+def row_limits(caps, rates):
+    '''
+    Monthly spend limit of each category of a card row earning rates, for
+    the caps of its card (see card_caps), inf where unlimited. A combined
+    limit is split evenly between the categories the row earns it in.
+    '''
+    limits = np.full(len(rates), np.inf)
+    for columns, limit, combined in caps:
+        earning = [column for column in columns if rates[column] > 0]
+        for column in earning:
+            limits[column] = limit / len(earning) if combined else limit
+    return limits
+
+
+class ChoiceCard:
+    '''
+    A card whose bonus categories the user picks. process_data expands it
+    into one row per choice; the engine instead picks the categories with
+    the largest gains directly.
+
+    Attributes
+        name: str          : card name, its key in comb_dict
+        rows: tuple        : catalog rows of every choice, in
+                             combinations(options, picks) order
+        options: int array : categories that can be picked
+        rates: float array : cash back of each option
+        picks: int         : number of categories picked
+        select_key: str    : key of the picked categories in select_cat
+        image: str         : id of the card image and url
+    '''
+    __slots__ = ('name', 'rows', 'options', 'rates', 'picks', 'select_key',
+                 'image', 'row_of')
+
+    def __init__(self, name, rows, options, rates, picks, select_key, image):
+        self.name, self.rows, self.picks = name, tuple(rows), picks
+        self.options = np.array(options, dtype=np.intp)
+        self.rates = np.array(rates, dtype=np.float64)
+        for array in (self.options, self.rates):
+            array.flags.writeable = False
+        self.select_key, self.image = select_key, image
+        # positions of the picked options -> catalog row
+        self.row_of = dict(zip(combinations(range(len(options)), picks),
+                               self.rows))
+
+    def pick(self, gains):
+        '''
+        Catalog row of the choice with the largest total gain. Ties go to
+        the earliest options, like the first row of process_data.
+        '''
+        best = np.argsort(-np.asarray(gains), kind='stable')[:self.picks]
+        return self.row_of[tuple(sorted(int(i) for i in best))]
+
+    def to_dict(self):
+        return {'name': self.name, 'rows': list(self.rows),
+                'options': self.options.tolist(),
+                'rates': self.rates.tolist(), 'picks': self.picks,
+                'select_key': self.select_key, 'image': self.image}
+
+
+class CardCatalog:
+    '''
+    Read-only reward data of every card row returned by process_data.
+
+    Attributes
+        rates: float array : (cards, categories) cash back percentages
+        categories: tuple  : category names, the columns of rates
+        names: tuple       : card name of every row
+        fees: float array  : (cards,) monthly annual fee of every row
+        members: array     : (cards, memberships) 1 where a row needs
+                             the membership
+        divisors: array    : (cards,) rotating category divisor of every
+                             row, 0 for cards with fixed categories
+        memberships: tuple : (attr key, annual cost, member_rec key) of
+                             every column of members
+        choices: tuple     : ChoiceCard of every choice card
+        limits: float array: (cards, categories) monthly spend every row
+                             earns its rate on, inf where unlimited
+        capped: bool       : whether any limit is finite
+        dominators: tuple  : rows dominating every row, see dominance.py
+    '''
+    __slots__ = ('rates', 'categories', 'names', 'fees', 'members',
+                 'divisors', 'memberships', 'choices', 'limits', 'capped',
+                 'dominators')
+
+    def __init__(self, rates, categories, names, fees, members, divisors,
+                 memberships=(), choices=(), limits=None):
+        if limits is None:
+            limits = np.full(np.shape(rates), np.inf)
+        arrays = [np.array(array, dtype=np.float64, order='C')
+                  for array in (rates, fees, members, divisors, limits)]
+        self._wrap(*arrays, categories, names, memberships, choices)
+
+    @classmethod
+    def from_arrays(cls, rates, categories, names, fees, members, divisors,
+                    memberships=(), choices=(), limits=None):
+        '''
+        Wraps existing read-only arrays without copying them, e.g. views of
+        a memory mapped binary catalog
+        '''
+        if limits is None:
+            limits = np.full(np.shape(rates), np.inf)
+        catalog = cls.__new__(cls)
+        catalog._wrap(rates, fees, members, divisors, limits, categories,
+                      names, memberships, choices)
+        return catalog
+
+    def _wrap(self, rates, fees, members, divisors, limits, categories,
+              names, memberships, choices):
+        for array in (rates, fees, members, divisors, limits):
+            if array.flags.writeable:
+                array.flags.writeable = False
+        self.rates, self.fees, self.members = rates, fees, members
+        self.divisors, self.limits = divisors, limits
+        self.capped = bool(np.isfinite(limits).any())
+        self.categories, self.names = tuple(categories), tuple(names)
+        self.memberships = tuple(tuple(m) for m in memberships)
+        self.choices = tuple(choices)
+        self.dominators = dominators(
+            rates, fees, members, divisors,
+            [row for choice in self.choices for row in choice.rows], limits)
+
+    def __len__(self):
+        return len(self.rates)
+
+    def choice_of(self, row):
+        '''ChoiceCard a row belongs to, or None for other cards'''
+        for choice in self.choices:
+            if row in choice.rows:
+                return choice
+        return None
+
+    def image_id(self, row):
+        '''Id of the image and url of a card row, see cc_urls'''
+        choice = self.choice_of(row)
+        return row if choice is None else choice.image
+
+    def membership_costs(self, attr):
+        '''Monthly cost of each membership the user does not already have'''
+        return np.array([0 if attr.get(key) else float(cost) / 12
+                         for key, cost, _ in self.memberships])
+
+    def card_costs(self, attr):
+        '''Monthly annual fee plus unpaid membership cost of every row'''
+        return self.fees + self.members @ self.membership_costs(attr)
+
+    def choice_limits(self, choice):
+        '''Monthly spend limit of every option of a ChoiceCard when picked'''
+        return self.limits[list(choice.rows)][:, choice.options].min(axis=0)
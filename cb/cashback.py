@@ -1,73 +1,104 @@
 '''
 Python backend for calculating cash back. Can operate as a script by itself
-without using flask app by running 'python cashback.py'
+without using flask app by running 'python -m cb.cashback' from the
+website folder.
 
 Made by Michael Wang in 2020
 '''
-import pandas as pd
+import argparse
+import heapq
+import os
+import sys
 import numpy as np
-from itertools import combinations, product
-
-
-def process_data(boa_multiplier):
-    '''Processes csv file based on boa multiplier and returns
-    intermediate logical dictionary 'comb_dict' to work with US bank
-    and BOA cards (assigning all combinations of choices to one card)
-    , a pandas dataframe 'card_vectors' that gives all rows of each
-    possible card's rewards, and 'card_names' which is a list of the
-    card names for all card rewards.
+from itertools import combinations
+from cb.cards import (CardCatalog, ChoiceCard, NO_RULE, card_caps,
+                      read_card_details, read_rules, row_limits)
+from cb.engine import (candidate_table, best_candidate, best_candidates,
+                       combo_values)
+from cb.ranking import TopCombos, core_key
+from cb.search import branch_and_bound, branch_and_bound_all, in_catalog_order
+
+# Card details with the spend limits of capped rewards
+DETAILS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'data.csv')
+
+
+def process_data(boa_multiplier, path='card_data.csv', rules_path=None,
+                 details_path=DETAILS_PATH):
+    '''Processes csv file based on boa multiplier, the rule table
+    (card_rules.csv next to it by default) and the spend limits in the
+    card details (cb/data.csv) and returns intermediate
+    logical dictionary 'comb_dict' to work with choice cards like US bank
+    and BOA (assigning all combinations of choices to one card), a
+    CardCatalog 'card_vectors' that gives all rows of each possible
+    card's rewards, and 'card_names' which is a list of the card names
+    for all card rewards.
     '''
-    data = pd.read_csv('card_data.csv')
+    import pandas as pd  # only needed to read the csv file
+    data = pd.read_csv(path)
+    rules = read_rules(rules_path or default_rules_path(path))
     categories = list(data.columns)[2:]
-    card_names = list(data.Card_Name)
-    card_vectors = data[categories]
-
-    us_bank_cats = card_vectors.loc[0, card_vectors.columns !=
-                                    'Foreign_Transactions']
-    us_bank_cats = us_bank_cats.to_numpy().nonzero()[0]
-    us_bank_combinations = combinations(us_bank_cats, 2)
-    boa_cats = card_vectors.loc[4, card_vectors.columns !=
-                                'Foreign_Transactions'].to_numpy().nonzero()[0]
-    boa_combinations = combinations(boa_cats, 1)
-
-    # intermediate df for for each choice of 2 categories in us bank card
-    us_bank_vec = []
-    for c in us_bank_combinations:
-        temp_row = np.zeros(len(categories))
-        temp_row[list(c)] = card_vectors.iloc[0][list(c)]
-        us_bank_vec.append(temp_row)
-        card_names.append(card_names[0])
-    us_bank_df = pd.DataFrame(us_bank_vec, columns=categories)
-
-    # intermediate df for for each choice of 1 category in boa card
-    boa_vec = []
-    for c in boa_combinations:
-        temp_row = np.zeros(len(categories))
-        temp_row[list(c)[0]] = card_vectors.iloc[4][list(c)[0]]
-        boa_vec.append(temp_row)
-        card_names.append(card_names[4])
-    boa_df = pd.DataFrame(boa_vec, columns=categories)
-
-    # remove original boa and us bank rows, and remove from card names
-    card_vectors = card_vectors.drop(
-        index=card_vectors.index[[0, 4]]).reset_index(drop=True)
-    del card_names[4]
-    del card_names[0]
-
-    # attach intermediate rows
-    card_vectors = card_vectors.append(us_bank_df, ignore_index=True)
-    boa_df *= boa_multiplier
-    card_vectors = card_vectors.append(boa_df, ignore_index=True)
-
-    # assign index of new rows to us bank and boa card names
-    comb_dict = {}
-    for i in range(0, 15):
-        comb_dict[card_names[i]] = [i]
-    comb_dict[card_names[15]] = list(range(15, 25))
-    comb_dict[card_names[26]] = list(range(25, 29))
+    rates = data[categories].to_numpy(dtype=np.float64)
+    names, ids = list(data.Card_Name), list(data.Card_ID)
+    card_rules = [rules.get(int(card_id), NO_RULE) for card_id in ids]
+    caps = card_caps(read_card_details(details_path), categories)
+
+    memberships = []  # in order of first use
+    for rule in card_rules:
+        if rule['membership'] and rule['membership'] not in memberships:
+            memberships.append(rule['membership'])
+
+    # cards without choices keep their row, in csv order
+    card_vectors, card_names, row_rules, comb_dict = [], [], [], {}
+    limits = []
+    for i, rule in enumerate(card_rules):
+        if not rule['choose']:
+            comb_dict[names[i]] = [len(card_vectors)]
+            card_vectors.append(rates[i] * boa_multiplier
+                                if rule['boa_tiers'] else rates[i])
+            card_names.append(names[i])
+            row_rules.append(rule)
+            limits.append(row_limits(caps.get(names[i], ()), rates[i]))
+
+    # intermediate rows for each choice of categories in choice cards
+    choosable = np.array(categories) != 'Foreign_Transactions'
+    choices = []
+    for i, rule in enumerate(card_rules):
+        if not rule['choose']:
+            continue
+        row = rates[i] * boa_multiplier if rule['boa_tiers'] else rates[i]
+        options = np.flatnonzero((row != 0) & choosable)
+        rows = []
+        for c in combinations(options, rule['choose']):
+            temp_row = np.zeros(len(categories))
+            temp_row[list(c)] = row[list(c)]
+            rows.append(len(card_vectors))
+            card_vectors.append(temp_row)
+            card_names.append(names[i])
+            row_rules.append(rule)
+            limits.append(row_limits(caps.get(names[i], ()), temp_row))
+        comb_dict[names[i]] = rows
+        choices.append(ChoiceCard(names[i], rows, options, row[options],
+                                  rule['choose'], rule['choice_key'],
+                                  rule['image']))
+
+    # compile the rules of every row into arrays
+    fees = np.array([rule['fee'] / 12 for rule in row_rules])
+    members = np.array([[float(rule['membership'] == m) for m in memberships]
+                        for rule in row_rules]).reshape(len(row_rules), -1)
+    divisors = np.array([rule['divisor'] for rule in row_rules])
+    card_vectors = CardCatalog(np.reshape(card_vectors, (-1, len(categories))),
+                               categories, card_names, fees, members,
+                               divisors, memberships, choices,
+                               np.reshape(limits, (-1, len(categories))))
     return comb_dict, card_vectors, card_names
 
 
+def default_rules_path(path):
+    '''The rule table belonging to a card data csv file'''
+    return os.path.join(os.path.dirname(path), 'card_rules.csv')
+
+
 def calc_cb(comb_dict, num_cards, card_vectors, card_names, spend, attr):
     '''
     Main function to calculate the best combination of credit cards
@@ -76,76 +107,173 @@ def calc_cb(comb_dict, num_cards, card_vectors, card_names, spend, attr):
     Params
         comb_dict: dict : mapping of card names to respective row indices
         num_cards: int  : number of cards desired by user
-        card_vectors: df: dataframe of cash back percentages for each selection
+        card_vectors: CardCatalog: cash back percentages for each selection
         card_names: list: list of names for each row in card_vectors
         spend: np array : input spend of each category
         attr: dict      : whether or not user is member of clubs
     '''
 
-    # decide number of cards to guarantee optimization, then use heuristic
-    max_cb, best_combo, member_rec, additional_cards = 0, [4], {}, 0
+    max_cb, best_combo, member_rec = 0, [4], {}
     if num_cards > 3:
-        additional_cards = num_cards - 3
-        num_cards = 3
-
-    # Iterate through all combinations based on rules set by dictionary
-    for comb in combinations(sorted(comb_dict), num_cards):
-        for uniquecomb in product(*[comb_dict[i] for i in comb]):
-            temp_cb = calc_temp_cb(card_vectors, spend,
-                                   uniquecomb, num_cards, attr)
-            if temp_cb > max_cb:  # if we find a better combination, then...
-                max_cb = temp_cb
-                best_combo = uniquecomb
-                member_rec = recommend_membership(attr, uniquecomb)
-
-    # If we chose more than 3 cards, use heuristic for the rest
-    if additional_cards > 0:
-        best_combo = list(best_combo)
-        before_cb = max_cb
-        all_cards = range(len(comb_dict))
-        us_bank = [15, 16, 17, 18, 19, 20, 21, 22, 23, 24]
-        boa = [25, 26, 27, 28]
-        us_bank_overlap = [i for i in us_bank if i in best_combo]
-        boa_overlap = [i for i in boa if i in best_combo]
-        if us_bank_overlap:
-            all_cards = [i for i in all_cards if i not in us_bank]
-        if boa_overlap:
-            all_cards = [i for i in all_cards if i not in us_bank]
-
-        # empty list of additional cards we decide to add after 3 optimal
-        added_cards = []
-
-        for c in range(additional_cards):  # for each additional card slot
-            # only look at non added cards
-            us_bank_overlap = [i for i in us_bank if i in added_cards]
-            boa_overlap = [i for i in boa if i in added_cards]
-            if us_bank_overlap:
-                all_cards = [i for i in all_cards if i not in us_bank]
-            if boa_overlap:
-                all_cards = [i for i in all_cards if i not in boa]
-            for new_card in all_cards:  # for all potential cards we can add,
-                temp_cb = calc_temp_cb(card_vectors, spend,
-                                       best_combo + [new_card],
-                                       num_cards, attr)
-                if temp_cb > max_cb:  # which is the next card we should add?
-                    max_cb = temp_cb
-                    best_card = new_card
-            if max_cb > before_cb:  # if the card improves our cash back
-                best_combo.append(best_card)
-                before_cb = max_cb
-                added_cards.append(best_card)
+        # too many combinations to score them all, search exactly instead
+        temp_cb, combo = branch_and_bound(comb_dict, num_cards, card_vectors,
+                                          spend, attr, prune=True)
+        if combo is not None:
+            max_cb, best_combo = temp_cb, combo
+            member_rec = recommend_membership(attr, best_combo, card_vectors)
+    else:
+        # Score all combinations based on rules set by dictionary at once,
+        # leaving out dominated cards that can not be part of the optimum
+        table = candidate_table(comb_dict, card_vectors, num_cards,
+                                prune=True)
+        best, temp_cb = best_candidate(table, spend, attr)
+        if best is not None:  # if we find a combination earning cash back
+            max_cb = temp_cb
+            best_combo = table.combo(best, spend)
+            member_rec = recommend_membership(attr, best_combo, card_vectors)
+
+    select_cat = selected_categories(best_combo, card_vectors, card_names)
+    return max_cb, best_combo, member_rec, select_cat
+
+
+def calc_cb_top(comb_dict, num_cards, card_vectors, card_names, spend, attr,
+                n):
+    '''
+    The n best distinct combinations for calc_cb's inputs, best first, as a
+    list of calc_cb results. Combinations only differing in cards that add
+    no cash back, or in the categories picked for a choice card, count as
+    one. The first result matches calc_cb up to ties. Dominated cards are
+    kept, as runner-ups may hold them.
+    '''
+    top = TopCombos(n, core_key(card_vectors, card_names, spend, attr))
+    if num_cards > 3:
+        branch_and_bound_all(comb_dict, num_cards, card_vectors, spend, attr,
+                             [num_cards], top=top)
+    else:
+        table = candidate_table(comb_dict, card_vectors, num_cards)
+        bounds = table.bound(spend, attr)
+        order = np.argsort(-bounds, kind='stable')
+        # Limits only lower cash back, so candidates are scored best bound
+        # first and offered best first, ties in the order calc_cb breaks
+        # them, once no bound left can beat them
+        scored, start = [], 0
+        while True:
+            bound = bounds[order[start]] if start < len(order) else -np.inf
+            while scored and -scored[0][0] > bound:
+                temp_cb, i = heapq.heappop(scored)
+                if -temp_cb > top.threshold():
+                    top.offer(-temp_cb, table.combo(i, spend))
+            if max(bound, -scored[0][0] if scored else -np.inf) \
+                    <= top.threshold():
+                break
+            candidates = order[start:start + 32]
+            start += len(candidates)
+            for i, temp_cb in zip(candidates, table.scores_of(
+                    candidates, spend, attr, bounds)):
+                heapq.heappush(scored, (-float(temp_cb), int(i)))
+    results = []
+    for temp_cb, combo in top.ranked():
+        combo = in_catalog_order(comb_dict, combo)
+        results.append((temp_cb, combo,
+                        recommend_membership(attr, combo, card_vectors),
+                        selected_categories(combo, card_vectors, card_names)))
+    return results
+
+
+def calc_cb_all(comb_dict, max_cards, card_vectors, card_names, spend, attr):
+    '''
+    calc_cb for every number of cards from 1 to max_cards in one pass.
+    Up to 3 cards the candidate tables are scored as in calc_cb; their
+    optima then seed a single search shared by all larger counts, so the
+    cost is close to one calc_cb for max_cards. Returns a list of calc_cb
+    results, the first one for 1 card.
+    '''
+    results = [calc_cb(comb_dict, num_cards, card_vectors, card_names,
+                       spend, attr)
+               for num_cards in range(1, min(max_cards, 3) + 1)]
+    if max_cards > 3:
+        seeds = [(max_cb, best_combo) for max_cb, best_combo, _, _ in results
+                 if max_cb > 0]
+        searched = branch_and_bound_all(comb_dict, max_cards, card_vectors,
+                                        spend, attr, range(4, max_cards + 1),
+                                        seeds, prune=True)
+        for temp_cb, combo in searched[4:]:
+            max_cb, best_combo, member_rec = 0, [4], {}
+            if combo is not None:
+                max_cb, best_combo = temp_cb, combo
+                member_rec = recommend_membership(attr, best_combo,
+                                                  card_vectors)
+            results.append((max_cb, best_combo, member_rec,
+                            selected_categories(best_combo, card_vectors,
+                                                card_names)))
+    return results
+
+
+def marginal_values(results):
+    '''
+    Cash back each extra card adds, for a list of calc_cb results by number
+    of cards as returned by calc_cb_all
+    '''
+    max_cbs = [max_cb for max_cb, _, _, _ in results]
+    return [max_cb - before for max_cb, before in zip(max_cbs, [0] + max_cbs)]
+
 
+def calc_cb_batch(comb_dict, num_cards, card_vectors, card_names,
+                  spends, attrs):
+    '''
+    calc_cb for many spend arrays sharing one catalog and number of cards.
+    Up to 3 cards, every profile is scored against every combination in one
+    matrix product. Returns a list of calc_cb results in input order.
+    '''
+    if num_cards > 3:
+        return [calc_cb(comb_dict, num_cards, card_vectors, card_names,
+                        spend, attr) for spend, attr in zip(spends, attrs)]
+
+    table = candidate_table(comb_dict, card_vectors, num_cards, prune=True)
+    results, select_cats = [], {}  # few distinct combos win in a batch
+    for spend, best, temp_cb, attr in zip(
+            spends, *best_candidates(table, spends, attrs), attrs):
+        max_cb, best_combo, member_rec = 0, (4,), {}
+        if best >= 0:
+            max_cb = float(temp_cb)
+            best_combo = table.combo(best, spend)
+            member_rec = recommend_membership(attr, best_combo, card_vectors)
+        if best_combo not in select_cats:
+            select_cats[best_combo] = selected_categories(
+                best_combo, card_vectors, card_names)
+        results.append((max_cb, best_combo, member_rec,
+                        dict(select_cats[best_combo])))
+    return results
+
+
+def selected_categories(best_combo, card_vectors, card_names):
+    '''
+    Which categories of choice cards (U.S. Bank and BOA) were selected
+    in the best combination
+    '''
     select_cat = {}
-    # Which categories of choose cards selected?
     if best_combo:  # if we entered values
         for card in best_combo:
-            if card_names[card] == card_names[15]:
-                s = card_vectors.iloc[card]
-                select_cat['us_bank'] = list(s.axes[0][s > 0])
-            if card_names[card] == card_names[25]:
-                s = card_vectors.iloc[card]
-                select_cat['boa'] = list(s.axes[0][s > 0])
-    return max_cb, best_combo, member_rec, select_cat
+            choice = card_vectors.choice_of(card)
+            if choice is not None:
+                s = card_vectors.rates[card]
+                select_cat[choice.select_key] = [
+                    card_vectors.categories[i] for i in np.flatnonzero(s > 0)]
+    return select_cat
+
+
+def get_boa_multiplier(boa_amt):
+    '''
+    Depending on capital in existing BOA accounts, the user
+    qualifies for a rewards level that increases cash back.
+    '''
+    if boa_amt >= 100000:
+        return 1.75
+    elif boa_amt >= 50000:
+        return 1.5
+    elif boa_amt >= 20000:
+        return 1.25
+    return 1
 
 
 def calc_stats(spend, max_cb):
@@ -163,68 +291,68 @@ def calc_temp_cb(card_vectors, spend, uniquecomb, num_cards, attr):
     For each selection of card combinations, calculates the cash back
     we would get. Handles all card types available.
     '''
+    spend = np.asarray(spend, dtype=np.float64)
+    cards = list(uniquecomb)
 
-    # calculate discover cash back advantage
-    # calculate earnings in cats
-    if 7 in uniquecomb and num_cards > 1:
-        temp_cb = sum(np.multiply(card_vectors.iloc[7, :].to_numpy(),
-                                  spend))
-
-        # get non-discover cards in uniquecomb
-        other_cards = np.array([card for card in uniquecomb if card != 7])
-        # indices of discover categories
-        d_ind = np.array(card_vectors.iloc[7, :].to_numpy().nonzero())[0]
-        other_cb = sum(np.multiply(card_vectors.iloc[other_cards, d_ind].to_numpy()[0],
-                                   spend[d_ind]))
-        # discover cash back in cats - other cards in those same cats divided by
-        temp_cb = (temp_cb - other_cb) / 4
-        all_other_cb = sum(np.multiply(card_vectors.iloc[other_cards, :].to_numpy()[0],
-                                       spend))
-        temp_cb += all_other_cb  # add net cb to all other cards
-
-    # if discover is our only card
-    elif 7 in uniquecomb:
-        temp_cb = sum(np.multiply(
-            card_vectors.iloc[7, :].to_numpy(), spend)) / 4
-
-    # if discover isn't there
-    else:
-        best_cb = card_vectors.iloc[list(uniquecomb), :].max(axis=0)
-        temp_cb = sum(np.multiply(best_cb, spend))
-
-    # Annual fees subtract from cash back
-    if 1 in uniquecomb:
-        temp_cb -= float(95) / 12
-    if 6 in uniquecomb:
-        temp_cb -= float(99) / 12
-    if 14 in uniquecomb:
-        temp_cb -= float(95) / 12
-    # Membership costs
-    if 11 in uniquecomb and not attr['sams_member']:
-        temp_cb -= float(45) / 12
-    if 3 in uniquecomb and not attr['amazon_member']:
-        temp_cb -= float(119) / 12
-    if 0 in uniquecomb and not attr['costco_member']:
-        temp_cb -= float(60) / 12
+    # calculate earnings in cats, splitting the spend of capped categories
+    # over the cards and including the rotating categories of cards like
+    # Discover (see Allocation)
+    temp_cb = combo_values(card_vectors, [cards], spend)[0]
 
+    # Annual fees and membership costs subtract from cash back
+    temp_cb -= card_vectors.card_costs(attr)[cards].sum()
     return temp_cb
 
 
-def recommend_membership(attr, uniquecomb):
+def recommend_membership(attr, uniquecomb, card_vectors):
+    '''
+    Memberships the user would have to buy for the cards in uniquecomb,
+    e.g. {'SC': True} for a Sam's Club membership
+    '''
     member_rec = {}
-    if 11 in uniquecomb and not attr['sams_member']:
-        # We will recommend getting a sam's membership
-        member_rec['SC'] = True
-    if 3 in uniquecomb and not attr['amazon_member']:
-        # Recommend getting amazon membership
-        member_rec['AMZN'] = True
-    if 0 in uniquecomb and not attr['costco_member']:
-        # Recommend getting costco membership
-        member_rec['COSTCO'] = True
+    needed = card_vectors.members[list(uniquecomb)].any(axis=0)
+    for (key, _, rec), need in zip(card_vectors.memberships, needed):
+        if need and not attr.get(key):
+            member_rec[rec] = True
     return member_rec
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Find the credit cards that maximize cash back. '
+        'Asks for one spend profile unless --batch is given.')
+    parser.add_argument('--batch', metavar='FILE',
+                        help="csv or jsonl file of spend profiles, '-' for "
+                        'stdin. Writes one JSON result per line')
+    parser.add_argument('--format', choices=['csv', 'jsonl'],
+                        help='input format, guessed from the file extension '
+                        'by default (jsonl for stdin)')
+    parser.add_argument('--output', default='-',
+                        help="file for results, '-' for stdout (default)")
+    parser.add_argument('--chunk-size', type=int, default=10000,
+                        help='profiles scored at a time (default 10000)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='processes scoring chunks, 0 for all cores')
+    parser.add_argument('--catalog', default='card_data.csv',
+                        help='card data csv file (default card_data.csv)')
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
+    args = parse_args()
+    if args.batch is not None:
+        from cb.batch import run_batch
+        fmt = args.format or ('csv' if args.batch.endswith('.csv')
+                              else 'jsonl')
+        infile = (sys.stdin if args.batch == '-'
+                  else open(args.batch, newline=''))
+        outfile = (sys.stdout if args.output == '-'
+                   else open(args.output, 'w'))
+        with infile, outfile:
+            errors = run_batch(infile, outfile, fmt, args.chunk_size,
+                               args.workers, args.catalog)
+        sys.exit(1 if errors else 0)
+
     # Get User Input
     print("Please enter avg. monthly spend for the following categories:\n")
     spend, attr = [], {}  # spend and attributes
@@ -259,12 +387,7 @@ if __name__ == "__main__":
     if attr['boa']:
         boa_amt = int(
             input("How much capital do you have in existing BoA accounts?: "))
-        if boa_amt >= 100000:
-            boa_multiplier = 1.75
-        elif boa_amt >= 50000:
-            boa_multiplier = 1.5
-        elif boa_amt >= 20000:
-            boa_multiplier = 1.25
+        boa_multiplier = get_boa_multiplier(boa_amt)
     else:
         boa_multiplier = 1
 
@@ -0,0 +1,101 @@
+'''
+Keeps the processed credit card catalog in memory so the csv file is not
+parsed on every cash back request. The (comb_dict, card_vectors,
+card_names) triple returned by process_data is built once for every Bank
+of America rewards tier and rebuilt whenever the csv file, its rule table
+or the card details with the spend limits change on disk.
+When an up to date binary catalog is available (see binary_catalog.py),
+the tiers are memory mapped from it instead of parsing the csv file.
+'''
+import os
+import threading
+from types import MappingProxyType
+from cb.binary_catalog import is_current, load_binary_catalog
+from cb.cards import BOA_TIERS
+from cb.cashback import DETAILS_PATH, default_rules_path, process_data
+
+
+class CatalogCache:
+    '''
+    Read-only cache of process_data results, one entry per BOA tier.
+    Every lookup checks the mtimes of the csv file, its rule table and the
+    card details and reloads all tiers when they changed. If binary names
+    a binary catalog compiled from the same files, tiers are mapped from
+    it. Counts hits, misses and reloads for monitoring.
+    '''
+
+    def __init__(self, path='card_data.csv', tiers=BOA_TIERS, binary=None):
+        self.path, self.binary = path, binary
+        self.tiers = tuple(tiers)
+        self.source = None
+        self.hits, self.misses, self.reloads = 0, 0, 0
+        self.version = 0
+        self._mtime = None
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        '''Builds the entries for every tier, called once at startup'''
+        with self._lock:
+            self._build(self._source_mtime())
+
+    def refresh(self):
+        '''
+        Reloads all tiers if the csv file, its rule table or the card
+        details changed since the last build and returns the current
+        catalog version.
+        '''
+        mtime = self._source_mtime()
+        if mtime != self._mtime:
+            with self._lock:
+                if mtime != self._mtime:
+                    if self._mtime is not None:
+                        self.reloads += 1
+                    self._build(mtime)
+        return self.version
+
+    def get(self, boa_multiplier):
+        '''
+        Returns (comb_dict, card_vectors, card_names) for a BOA multiplier.
+        Multipliers outside of the prebuilt tiers are built on first use.
+        '''
+        self.refresh()
+        entry = self._entries.get(boa_multiplier)
+        if entry is not None:
+            self.hits += 1
+            return entry
+        with self._lock:
+            self.misses += 1
+            entry = _freeze(*process_data(boa_multiplier, self.path))
+            self._entries = {**self._entries, boa_multiplier: entry}
+        return entry
+
+    def stats(self):
+        '''Counters and state of the cache as a dictionary'''
+        return {'hits': self.hits, 'misses': self.misses,
+                'reloads': self.reloads, 'version': self.version,
+                'tiers': sorted(self._entries), 'source': self.source}
+
+    def _source_mtime(self):
+        return (os.path.getmtime(self.path),
+                os.path.getmtime(default_rules_path(self.path)),
+                os.path.getmtime(DETAILS_PATH))
+
+    def _build(self, mtime):
+        mapped, self.source = {}, 'csv'
+        if self.binary and is_current(self.binary, self.path):
+            mapped, self.source = load_binary_catalog(self.binary), 'binary'
+        # Swap in a complete dictionary so readers never see a partial build
+        self._entries = {
+            tier: _freeze(*(mapped[tier] if tier in mapped
+                            else process_data(tier, self.path)))
+            for tier in self.tiers}
+        self._mtime = mtime
+        self.version += 1
+
+
+def _freeze(comb_dict, card_vectors, card_names):
+    '''Wraps a process_data result in immutable containers'''
+    comb_dict = MappingProxyType({name: tuple(rows)
+                                  for name, rows in comb_dict.items()})
+    return comb_dict, card_vectors, tuple(card_names)
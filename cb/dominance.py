@@ -0,0 +1,69 @@
+'''
+Spend independent dominance between cards. A card dominates another when
+it earns at least as much in every category, has no higher annual fee,
+needs no membership the other one does not and has no spend limit in the
+categories the other one earns in. Whatever the spend and
+memberships, swapping a dominated card for its dominator, or dropping it
+next to its dominator, never lowers cash back, so searches can skip
+dominated cards without changing the optimum; ties may go to the
+dominator instead.
+
+Only cards with one row of fixed categories are compared. Choice cards
+pick their rates and rotating categories do not combine by taking the
+best rate.
+'''
+import numpy as np
+
+
+def dominators(rates, fees, members, divisors, choice_rows=(), limits=None):
+    '''
+    Rows dominating every row, a tuple of tuples indexed by row. Of two
+    identical rows, the first one dominates the other. A capped dominator
+    could not take the spend of the dropped card beyond its limit, so it
+    needs unlimited (inf) limits where the other row earns.
+    '''
+    comparable = divisors == 0
+    comparable[list(choice_rows)] = False
+    rows = np.flatnonzero(comparable)
+    unlimited = (np.isinf(limits[rows]) if limits is not None
+                 else np.ones(rates[rows].shape, dtype=bool))
+    result = [()] * len(rates)
+    for b in rows:
+        at_least = ((rates[rows] >= rates[b]).all(axis=1)
+                    & (fees[rows] <= fees[b])
+                    & (members[rows] <= members[b]).all(axis=1)
+                    & (unlimited | (rates[b] <= 0)).all(axis=1))
+        same = ((rates[rows] == rates[b]).all(axis=1)
+                & (fees[rows] == fees[b])
+                & (members[rows] == members[b]).all(axis=1))
+        result[b] = tuple(int(a) for a
+                          in rows[at_least & (~same | (rows < b))])
+    return tuple(result)
+
+
+def pruned_names(card_vectors, num_cards=None):
+    '''
+    Names of the dominated cards a search for num_cards cards may skip,
+    for a search of at most that many cards when num_cards is None.
+
+    A combination of exactly num_cards cards holding a card and its
+    dominator can only drop the dominated card if another card with no
+    fee or membership takes its place, so dominated cards are only
+    skipped when there are at least num_cards such cards left.
+    '''
+    dominated = {card_vectors.names[row] for row, rows
+                 in enumerate(card_vectors.dominators) if rows}
+    if num_cards is not None:
+        costly = card_vectors.members.any(axis=1) | (card_vectors.fees != 0)
+        free = set(card_vectors.names) - {
+            name for name, paid in zip(card_vectors.names, costly) if paid}
+        if len(free - dominated) < num_cards:
+            return frozenset()
+    return frozenset(dominated)
+
+
+def dominance_report(card_vectors):
+    '''JSON friendly list of the dominated cards and their dominators'''
+    return [{'card': card_vectors.names[row], 'row': row,
+             'dominated_by': [card_vectors.names[a] for a in rows]}
+            for row, rows in enumerate(card_vectors.dominators) if rows]
@@ -0,0 +1,692 @@
+'''
+Vectorized scoring engine for the cash back calculator. Instead of calling
+calc_temp_cb once per combination, every candidate combination is stored
+as one row of an integer index array and all of them are scored with a
+few numpy operations. Choice cards pick their categories while scoring
+instead of adding one candidate per choice.
+
+The part of the score that does not depend on spend (effective reward
+rates, annual fees, membership cards) is computed once per catalog and
+number of cards, so scoring a spend profile is a single matrix product.
+
+Rewards with a spend limit (see CardCatalog.limits) are not linear in
+spend: past its limit a card earns nothing more in the category and the
+rest of the spend goes to the next best card of the combination. Within a
+category that greedy fill, best rate first, is the optimal split, and the
+order only depends on the rates, so Allocation sorts it once per set of
+combinations and scoring is a clip and a sum per combination, category
+and card. Candidates holding a capped card are scored that way, the
+others as before.
+'''
+import threading
+from collections import OrderedDict
+from itertools import combinations, product
+import numpy as np
+from cb.dominance import pruned_names
+
+_TABLE_CACHE_SIZE = 32
+# Most (candidate, profile, category, card) cells allocated at once
+_ALLOCATION_BLOCK = 1 << 20
+_tables = OrderedDict()
+_tables_lock = threading.Lock()
+
+
+class CandidateTable:
+    '''
+    Every set of cards calc_cb considers for a number of cards, in the
+    order of comb_dict, with the spend independent part of its cash back.
+
+    Choice cards (see ChoiceCard) take one candidate per set of cards
+    rather than one per choice: their categories are picked when scoring,
+    as the options with the largest gains over the other cards. Two choice
+    cards sharing options would make those gains depend on each other, so
+    all but the first of them are expanded into their rows instead.
+    With prune, sets holding a dominated card (see dominance.py) are left
+    out where that can not change the best candidate. Candidates holding a
+    card with a spend limit, or picking a choice card with one, are scored
+    by allocation (see CappedCandidates) where a limit binds, and pick
+    their categories by the capped gains.
+
+    Attributes
+        combos: int array  : (n, num_cards) card rows of each candidate,
+                             the first row of picked choice cards
+        rates: float array : (n, categories) effective reward rates
+                             before choice card picks
+        fees: float array  : (n,) monthly annual fees
+        members: array     : (n, memberships) memberships needed
+        positions: array   : (n, choices) column of each picked choice card
+                             in combos, -1 when it is not picked
+        lifts: list        : (n_c, options) rate each option of choice c
+                             adds to the candidates picking it, with the
+                             candidate indices, per choice card
+        capped: object     : CappedCandidates, None without limits
+    '''
+
+    def __init__(self, comb_dict, card_vectors, num_cards, prune=False):
+        self.choices = card_vectors.choices
+        self.membership_costs = card_vectors.membership_costs
+        choice_index = {choice.name: c for c, choice
+                        in enumerate(self.choices)}
+
+        skipped = pruned_names(card_vectors, num_cards) if prune else ()
+        combos, picked = [], []
+        for comb in combinations(sorted(set(comb_dict) - set(skipped)),
+                                 num_cards):
+            picks, taken = [], set()
+            for name in comb:
+                c = choice_index.get(name)
+                if c is not None and not taken & set(self.choices[c].options):
+                    picks.append(name)
+                    taken.update(self.choices[c].options)
+            rows = [comb_dict[i][:1] if i in picks else comb_dict[i]
+                    for i in comb]
+            for uniquecomb in product(*rows):
+                combos.append(uniquecomb)
+                picked.append([j for j, i in enumerate(comb) if i in picks])
+        self.combos = np.array(combos, dtype=np.intp).reshape(-1, num_cards)
+
+        # picked choice cards earn nothing before their picks
+        is_picked = np.zeros(self.combos.shape, dtype=bool)
+        for i, columns in enumerate(picked):
+            is_picked[i, columns] = True
+        zero = len(card_vectors)
+        vectors = np.vstack([card_vectors.rates,
+                             np.zeros(card_vectors.rates.shape[1])])
+        divisors = np.append(card_vectors.divisors, 0)
+        rows = np.where(is_picked, zero, self.combos)
+        self.rates = effective_rates(vectors, divisors, rows)
+
+        self.positions = np.full((len(self.combos), len(self.choices)), -1,
+                                 dtype=np.intp)
+        self.lifts = []
+        for c, choice in enumerate(self.choices):
+            i, j = np.nonzero(is_picked & (self.combos == choice.rows[0]))
+            self.positions[i, c] = j
+            # rates of the candidates in the options, before and after
+            # picking them
+            options = vectors[rows[i]][..., choice.options]
+            before = _fixed_rates(options, divisors[rows[i]])
+            after = np.maximum(before, choice.rates)
+            lift = (_with_rotating(after, options, divisors[rows[i]])
+                    - _with_rotating(before, options, divisors[rows[i]]))
+            lift.flags.writeable = False
+            self.lifts.append((i, lift))
+
+        self.fees = card_vectors.fees[self.combos].sum(axis=1)
+        self.members = card_vectors.members[self.combos].max(axis=1)
+        self.capped = None
+        if card_vectors.capped:
+            self.capped = _capped_candidates(
+                card_vectors, vectors, rows, self.positions, self.rates)
+
+        for array in (self.combos, self.rates, self.fees, self.members,
+                      self.positions):
+            array.flags.writeable = False
+
+    def __len__(self):
+        return len(self.combos)
+
+    def score(self, spend, attr):
+        '''Monthly cash back of every candidate for one spend array'''
+        spend = np.asarray(spend, dtype=np.float64)
+        return self.score_many(spend[None], [attr])[:, 0]
+
+    def score_many(self, spends, attrs):
+        '''
+        Monthly cash back of every candidate (rows) for several spend arrays
+        and their membership flags (columns)
+        '''
+        spends = np.asarray(spends, dtype=np.float64)
+        scores = self._linear(spends, attrs)
+        if self.capped is not None:
+            step = max(1, _ALLOCATION_BLOCK // max(self.capped.base.cells, 1))
+            for start in range(0, len(spends), step):
+                stop = start + step
+                scores[self.capped.index, start:stop] = self._allocated(
+                    None, spends[start:stop], attrs[start:stop])
+        return scores
+
+    def bound(self, spend, attr):
+        '''bound_many for one spend array'''
+        spend = np.asarray(spend, dtype=np.float64)
+        return self.bound_many(spend[None], [attr])[:, 0]
+
+    def bound_many(self, spends, attrs, limits=True):
+        '''
+        Upper bounds of score_many, equal to the scores of the candidates
+        no spend limit binds for (see binding). With limits the capped
+        candidates are bounded by CapBound as well, otherwise only by their
+        cash back without limits, looser but cheaper (see bounds_of).
+        '''
+        spends = np.asarray(spends, dtype=np.float64)
+        scores = self._linear(spends, attrs)
+        if limits and self.capped is not None:
+            index = self.capped.index
+            scores[index] = np.minimum(scores[index], self._cap_bounds(
+                None, spends, attrs))
+        return scores
+
+    def bounds_of(self, candidates, spend, attr, bounds):
+        '''
+        bound with limits of some candidates (indices) for one spend
+        array, given its bounds from bound
+        '''
+        candidates = np.asarray(candidates, dtype=np.intp)
+        bounds = np.array(bounds[candidates], dtype=np.float64)
+        if self.capped is not None:
+            j = self.capped.positions(candidates)
+            capped = j >= 0
+            if capped.any():
+                spend = np.asarray(spend, dtype=np.float64)
+                bounds[capped] = np.minimum(bounds[capped], self._cap_bounds(
+                    j[capped], spend[None], [attr])[:, 0])
+        return bounds
+
+    def binding(self, spend):
+        '''
+        Which candidates a spend limit binds for at one spend array: the
+        only ones whose bound can be above their score
+        '''
+        binds = np.zeros(len(self.combos), dtype=bool)
+        if self.capped is not None:
+            spend = np.asarray(spend, dtype=np.float64)
+            binds[self.capped.index] = (spend[self.capped.columns]
+                                        > self.capped.bound.headroom
+                                        ).any(axis=1)
+        return binds
+
+    def scores_of(self, candidates, spend, attr, bounds):
+        '''
+        Monthly cash back of some candidates (indices) for one spend array,
+        given its bounds from bound, so only the candidates a limit binds
+        for are allocated
+        '''
+        candidates = np.asarray(candidates, dtype=np.intp)
+        scores = np.array(bounds[candidates], dtype=np.float64)
+        if self.capped is not None:
+            spend = np.asarray(spend, dtype=np.float64)
+            j = self.capped.positions(candidates)
+            binds = j >= 0
+            binds[binds] = (spend[self.capped.columns]
+                            > self.capped.bound.headroom[j[binds]]
+                            ).any(axis=1)
+            if binds.any():
+                scores[binds] = self._allocated(j[binds], spend[None],
+                                                [attr])[:, 0]
+        return scores
+
+    def _linear(self, spends, attrs):
+        '''score_many without spend limits'''
+        costs = np.array([self.membership_costs(attr) for attr in attrs])
+        scores = (self.rates @ spends.T - self.fees[:, None]
+                  - self.members @ costs.reshape(len(attrs), -1).T)
+        for choice, (rows, lift) in zip(self.choices, self.lifts):
+            if rows.size:
+                gains = lift[:, None] * spends[None, :, choice.options]
+                scores[rows] += _top_sum(gains, choice.picks)
+        return scores
+
+    def _cap_bounds(self, positions, spends, attrs):
+        '''
+        CapBound of the capped candidates, (m, p) for p spend arrays, or of
+        those at positions of the capped candidates only
+        '''
+        index, rest = self.capped.index, self.capped.rest
+        if positions is not None:
+            index, rest = index[positions], rest[positions]
+        costs = np.array([self.membership_costs(attr) for attr in attrs])
+        return (rest @ spends[:, self.capped.others].T
+                + self.capped.bound.values(spends[:, self.capped.columns],
+                                           positions).sum(axis=-1)
+                - self.fees[index, None]
+                - self.members[index] @ costs.reshape(len(attrs), -1).T)
+
+    def _allocated(self, positions, spends, attrs):
+        '''
+        Monthly cash back of the capped candidates, (m, p) for p spend
+        arrays, or of those at positions of the capped candidates only
+        '''
+        index, rest = self.capped.index, self.capped.rest
+        if positions is not None:
+            index, rest = index[positions], rest[positions]
+        costs = np.array([self.membership_costs(attr) for attr in attrs])
+        allocated, _ = self._allocate(spends, positions)
+        return (rest @ spends[:, self.capped.others].T + allocated
+                - self.fees[index, None]
+                - self.members[index] @ costs.reshape(len(attrs), -1).T)
+
+    def _allocate(self, spends, positions=None):
+        '''
+        Capped cash back of the capped candidates in the allocated columns,
+        (m, p) for p spend arrays, and per choice card the candidates
+        picking it (positions in the result) with the gain of each option,
+        (m_c, p, options). Only for the capped candidates at positions when
+        given.
+        '''
+        base = self.capped.base
+        spends = spends[:, self.capped.columns]
+        if positions is not None:
+            base = base.subset(positions)
+        values = base.values(spends)
+        total, gains = values.sum(axis=-1), []
+        for choice, (k, at, with_choice) in zip(self.choices,
+                                                self.capped.picking):
+            if positions is not None:
+                j = np.minimum(np.searchsorted(k, positions),
+                               max(len(k) - 1, 0))
+                found = (k[j] == positions if len(k)
+                         else np.zeros(len(positions), dtype=bool))
+                if not found.any():
+                    gains.append((np.flatnonzero(found),
+                                  np.zeros((0, len(spends), len(at)))))
+                    continue
+                k, with_choice = (np.flatnonzero(found),
+                                  with_choice.subset(j[found]))
+            gain = (with_choice.values(spends)[..., at]
+                    - values[k][..., at])
+            total[k] += _top_sum(gain, choice.picks)
+            gains.append((k, gain))
+        return total, gains
+
+    def combo(self, i, spend):
+        '''
+        Card rows of candidate i for a spend array, with the row of the
+        categories each choice card picks
+        '''
+        spend = np.asarray(spend, dtype=np.float64)
+        combo = [int(card) for card in self.combos[i]]
+        gains = None
+        j = (self.capped.positions([i]) if self.capped is not None
+             else np.array([-1]))
+        if j[0] >= 0 and (self.positions[i] >= 0).any() and (
+                spend[self.capped.columns]
+                > self.capped.bound.headroom[j[0]]).any():
+            _, gains = self._allocate(spend[None], j)
+        for c, (choice, (rows, lift)) in enumerate(zip(self.choices,
+                                                       self.lifts)):
+            if self.positions[i, c] >= 0:
+                if gains is not None:
+                    # the capped gains of the options
+                    combo[self.positions[i, c]] = choice.pick(
+                        gains[c][1][0, 0])
+                    continue
+                k = np.searchsorted(rows, i)
+                combo[self.positions[i, c]] = choice.pick(
+                    lift[k] * spend[choice.options])
+        return tuple(combo)
+
+
+class CappedCandidates:
+    '''
+    The candidates of a CandidateTable holding a row with a spend limit or
+    picking a choice card with one, see _capped_candidates.
+
+    Attributes
+        index: int array      : their candidate indices, in order
+        columns: int array    : categories scored by allocation, every
+                                limited category and choice option
+        others: int array     : the other categories
+        rest: float array     : (m, others) their rates in others
+        base: Allocation      : their rows in columns, picked choice cards
+                                as the zero row
+        picking: list         : per choice card (positions in index of the
+                                candidates picking it, columns of its
+                                options, Allocation with the choice card
+                                added at its option rates)
+        bound: CapBound       : their rows with every option of the choice
+                                cards they pick
+    '''
+    __slots__ = ('index', 'columns', 'others', 'rest', 'base', 'picking',
+                 'bound')
+
+    def positions(self, candidates):
+        '''Positions in index of candidate indices, -1 when not capped'''
+        candidates = np.asarray(candidates, dtype=np.intp)
+        j = np.minimum(np.searchsorted(self.index, candidates),
+                       len(self.index) - 1)
+        return np.where(self.index[j] == candidates, j, -1)
+
+
+def _capped_candidates(card_vectors, vectors, rows, positions,
+                       candidate_rates):
+    '''
+    CappedCandidates of a table with rows (picked choice cards as the
+    zero row of vectors) and choice card positions, None when no candidate
+    is capped
+    '''
+    categories = vectors.shape[1]
+    limits = np.vstack([card_vectors.limits, np.full(categories, np.inf)])
+    divisors = np.append(card_vectors.divisors, 0)
+    choice_limits = [card_vectors.choice_limits(choice)
+                     for choice in card_vectors.choices]
+    columns = np.isfinite(card_vectors.limits).any(axis=0)
+    for choice in card_vectors.choices:
+        columns[choice.options] = True
+    columns = np.flatnonzero(columns)
+
+    capped = np.isfinite(limits[rows]).any(axis=(1, 2))
+    for c, limit in enumerate(choice_limits):
+        if np.isfinite(limit).any():
+            capped |= positions[:, c] >= 0
+    index = np.flatnonzero(capped)
+    if not index.size:
+        return None
+    rows = rows[index]
+    rates, limits = vectors[rows][..., columns], limits[rows][..., columns]
+    divisors = divisors[rows]
+
+    result = CappedCandidates()
+    result.index, result.columns = index, columns
+    result.others = np.setdiff1d(np.arange(categories), columns)
+    result.rest = candidate_rates[index][:, result.others]
+    result.base = Allocation(rates, limits, divisors)
+    result.picking = []
+    # every option of the picked choice cards, a superset of their picks
+    tiers = [(rates, limits, divisors)]
+    for c, choice in enumerate(card_vectors.choices):
+        at = np.searchsorted(columns, choice.options)
+        picks = positions[index, c] >= 0
+        tier = np.zeros((len(index), 1, len(columns)))
+        tier_limits = np.zeros((len(index), 1, len(columns)))
+        tier[picks, 0, at[:, None]] = choice.rates[:, None]
+        tier_limits[picks, 0, at[:, None]] = choice_limits[c][:, None]
+        tiers.append((tier, tier_limits, np.zeros((len(index), 1))))
+        k = np.flatnonzero(picks)
+        result.picking.append((k, at, Allocation(
+            np.concatenate([rates[k], tier[k]], axis=1),
+            np.concatenate([limits[k], tier_limits[k]], axis=1),
+            np.concatenate([divisors[k], np.zeros((len(k), 1))], axis=1))))
+    result.bound = CapBound(*(np.concatenate(arrays, axis=1)
+                              for arrays in zip(*tiers)))
+    return result
+
+
+class Allocation:
+    '''
+    Capped cash back of combinations of card rows, given as rates and
+    spend limits (n, cards, categories) and rotating category divisors
+    (n, cards). The spend of a category goes to the cards best rate first,
+    each taking at most its limit, so spend beyond every limit earns
+    nothing. A card with rotating categories joins that order one in
+    divisor quarters, so it adds the difference it makes there divided by
+    divisor, the card adding most counting as in effective_rates. Without
+    limits this is effective_rates @ spend. Negative spend, refunds, earns
+    the effective rates.
+
+    The fill order is sorted once; values then clips every spend against
+    the stretch of spend each card takes.
+    '''
+
+    def __init__(self, rates, limits, divisors):
+        fixed = divisors == 0
+        self.linear = effective_rates(rates, divisors, None)
+        self.fixed = _tiers(rates, np.where(fixed[..., None], limits, 0))
+        self.rotating = []
+        for j in np.flatnonzero((~fixed).any(axis=0)):
+            enabled = fixed.copy()
+            enabled[:, j] = True
+            weight = np.where(fixed[:, j], 0,
+                              1 / np.where(fixed[:, j], 1, divisors[:, j]))
+            self.rotating.append((_tiers(rates, np.where(
+                enabled[..., None], limits, 0)), weight))
+        self.cells = self.fixed[0].size * (1 + len(self.rotating))
+
+    def subset(self, rows):
+        '''Allocation of the combinations rows only'''
+        subset = Allocation.__new__(Allocation)
+        subset.linear = self.linear[rows]
+        subset.fixed = tuple(array[rows] for array in self.fixed)
+        subset.rotating = [(tuple(array[rows] for array in tiers),
+                            weight[rows]) for tiers, weight in self.rotating
+                           if weight[rows].any()]
+        subset.cells = subset.fixed[0].size * (1 + len(subset.rotating))
+        return subset
+
+    def values(self, spends):
+        '''
+        Cash back of every combination in every category for (p,
+        categories) spend arrays, (n, p, categories)
+        '''
+        positive = np.maximum(spends, 0)
+        values = _fill(self.fixed, positive)
+        bonus = 0
+        for tiers, weight in self.rotating:
+            bonus = np.maximum(bonus, (_fill(tiers, positive) - values)
+                               * weight[:, None, None])
+        return (values + bonus
+                + self.linear[:, None] * np.minimum(spends, 0)[None])
+
+
+class CapBound:
+    '''
+    Upper bounds of Allocation.values that are much cheaper to compute,
+    for combinations given the same way. In a category, the spend taken by
+    the capped cards earns at most their rate and the rest at most U, the
+    best rate of the cards without a limit there (at least 0, what spend
+    beyond every limit earns), so the category earns at most
+    U * spend + limit * max(rate - U, 0) summed over the capped cards.
+    The bonus of a card with rotating categories is at most its rate on
+    the spend it can take, divided by its divisor. Where the cash back
+    without limits is lower, it is the bound instead.
+
+    headroom (n, categories) is the spend up to which no limit of a
+    combination binds: below it cash back is the one without limits.
+    '''
+
+    def __init__(self, rates, limits, divisors):
+        fixed = (divisors == 0)[..., None]
+        capped = np.isfinite(limits) & (rates > 0)
+        limited = np.where(capped, limits, 0)
+        self.linear = effective_rates(rates, divisors, None)
+        self.unlimited = np.where(fixed & ~capped, np.maximum(rates, 0),
+                                  0).max(axis=-2)
+        self.excess = np.where(fixed, limited * np.maximum(
+            rates - self.unlimited[..., None, :], 0), 0).sum(axis=-2)
+        # rates / divisor and limits of the cards with rotating categories,
+        # for the combinations holding one
+        self.rotating = np.flatnonzero(~fixed.all(axis=(1, 2)))
+        fixed = fixed[self.rotating]
+        self.rotating_rates = np.where(fixed, 0, np.maximum(
+            rates[self.rotating], 0) / np.where(
+                fixed, 1, divisors[self.rotating][..., None]))
+        self.rotating_limits = np.where(fixed, 0, limits[self.rotating])
+        self.headroom = np.where(capped, limits, np.inf).min(axis=-2)
+
+    def values(self, spends, positions=None):
+        '''
+        Bounds of the cash back of every combination in every category for
+        (p, categories) spend arrays, (n, p, categories), or of the
+        combinations at positions only
+        '''
+        positive = np.maximum(spends, 0)
+        linear, unlimited, excess = self.linear, self.unlimited, self.excess
+        rotating, rates, limits = (self.rotating, self.rotating_rates,
+                                   self.rotating_limits)
+        if positions is not None:
+            linear, unlimited, excess = (linear[positions],
+                                         unlimited[positions],
+                                         excess[positions])
+            k = np.searchsorted(rotating, positions)
+            found = k < len(rotating)
+            found[found] = rotating[k[found]] == positions[found]
+            rotating, rates, limits = (np.flatnonzero(found),
+                                       rates[k[found]], limits[k[found]])
+        bound = unlimited[:, None] * positive + excess[:, None]
+        if len(rotating):
+            bound[rotating] += (rates[:, None] * np.minimum(
+                limits[:, None], positive[None, :, None])).max(axis=2)
+        return (np.minimum(bound, linear[:, None] * positive)
+                + linear[:, None] * np.minimum(spends, 0)[None])
+
+
+def _tiers(rates, limits):
+    '''
+    Fill order of (n, cards, categories) rates and limits: the rates,
+    the spend each card starts taking at and its limit, sorted best rate
+    first, as (n, categories, cards) arrays
+    '''
+    rates, limits = np.swapaxes(rates, 1, 2), np.swapaxes(limits, 1, 2)
+    order = np.argsort(-rates, axis=-1, kind='stable')
+    rates = np.take_along_axis(rates, order, axis=-1)
+    limits = np.take_along_axis(limits, order, axis=-1)
+    starts = np.zeros_like(limits)
+    np.cumsum(limits[..., :-1], axis=-1, out=starts[..., 1:])
+    return rates, starts, limits
+
+
+def _fill(tiers, spends):
+    '''Cash back of (p, categories) spend arrays filled into tiers'''
+    rates, starts, limits = tiers
+    taken = np.clip(spends[None, :, :, None] - starts[:, None], 0,
+                    limits[:, None])
+    return np.einsum('npct,nct->npc', taken, rates)
+
+
+def combo_values(card_vectors, rows, spend):
+    '''
+    Monthly cash back of combinations, (n, cards) rows of card_vectors,
+    before fees and memberships, with their spend limits
+    '''
+    rows = np.asarray(rows, dtype=np.intp)
+    spend = np.asarray(spend, dtype=np.float64)
+    if not card_vectors.capped:
+        return effective_rates(card_vectors.rates, card_vectors.divisors,
+                               rows) @ spend
+    return Allocation(card_vectors.rates[rows], card_vectors.limits[rows],
+                      card_vectors.divisors[rows]).values(
+                          spend[None])[:, 0].sum(axis=-1)
+
+
+def effective_rates(vectors, divisors, rows):
+    '''
+    Reward rates of card combinations, (n, categories) for an (n, cards)
+    array of rows of vectors, or for (n, cards, categories) vectors and
+    (n, cards) divisors when rows is None. Every category earns the best
+    rate of the cards with fixed categories. A card with rotating
+    categories earns its rate there one in divisor quarters, and the best
+    fixed rate the rest of the year, so it adds max(rate - best, 0) /
+    divisor. Spend limits are ignored, so these rates bound the capped
+    cash back, see Allocation.
+    '''
+    if rows is None:
+        rates = vectors
+    else:
+        rates, divisors = vectors[rows], divisors[rows]
+    return _with_rotating(_fixed_rates(rates, divisors), rates, divisors)
+
+
+def _fixed_rates(rates, divisors):
+    '''Best rate of the cards with fixed categories, 0 without any'''
+    fixed = divisors == 0
+    best = np.where(fixed[..., None], rates, -np.inf).max(axis=-2)
+    return np.where(fixed.any(axis=-1)[..., None], best, 0)
+
+
+def _with_rotating(best, rates, divisors):
+    '''Adds the rotating category bonus of the cards to best'''
+    rotating = divisors > 0
+    if not rotating.any():
+        return best
+    scale = np.where(rotating, divisors, np.inf)[..., None]
+    return best + (np.maximum(rates - best[..., None, :], 0)
+                   / scale).max(axis=-2)
+
+
+def _top_sum(gains, picks):
+    '''Sum of the picks largest gains along the last axis'''
+    if picks == 1:
+        return gains.max(axis=-1)
+    return np.sort(gains, axis=-1)[..., -picks:].sum(axis=-1)
+
+
+def candidate_table(comb_dict, card_vectors, num_cards, prune=False):
+    '''
+    Returns the CandidateTable for a catalog and number of cards, reusing
+    a previously built table for the same catalog objects.
+    '''
+    key = (id(comb_dict), id(card_vectors), num_cards, prune)
+    with _tables_lock:
+        entry = _tables.get(key)
+        # ids can be reused once a catalog is garbage collected, so the
+        # cache keeps the catalog objects alive and checks them
+        if (entry is not None and entry[0] is comb_dict
+                and entry[1] is card_vectors):
+            _tables.move_to_end(key)
+            return entry[2]
+    table = CandidateTable(comb_dict, card_vectors, num_cards, prune)
+    with _tables_lock:
+        _tables[key] = (comb_dict, card_vectors, table)
+        if len(_tables) > _TABLE_CACHE_SIZE:
+            _tables.popitem(last=False)
+    return table
+
+
+def best_candidate(table, spend, attr):
+    '''
+    Index and cash back of the best candidate of a table, or (None, 0)
+    when no candidate earns positive cash back. Ties go to the first
+    candidate, as in calc_cb.
+    '''
+    spend = np.asarray(spend, dtype=np.float64)
+    return _best_of(table, table.bound_many(spend[None], [attr], False)[:, 0],
+                    spend, attr)
+
+
+def best_candidates(table, spends, attrs, chunk_size=256):
+    '''
+    best_candidate for several spend arrays. Returns an array of candidate
+    indices (-1 when no candidate earns positive cash back) and an array of
+    cash back. Profiles are scored chunk_size at a time to bound memory.
+    '''
+    best = np.full(len(spends), -1, dtype=np.intp)
+    max_cb = np.zeros(len(spends))
+    for start in range(0, len(spends), chunk_size):
+        stop = start + chunk_size
+        scores = table.bound_many(spends[start:stop], attrs[start:stop],
+                                  False)
+        if table.capped is not None:
+            for j in range(scores.shape[1]):
+                i, temp_cb = _best_of(table, scores[:, j], spends[start + j],
+                                      attrs[start + j])
+                if i is not None:
+                    best[start + j], max_cb[start + j] = i, temp_cb
+            continue
+        chunk_best = np.argmax(scores, axis=0)
+        chunk_cb = scores[chunk_best, np.arange(scores.shape[1])]
+        earns = chunk_cb > 0
+        best[start:stop][earns] = chunk_best[earns]
+        max_cb[start:stop][earns] = chunk_cb[earns]
+    return best, max_cb
+
+
+def _best_of(table, bounds, spend, attr, block=32):
+    '''
+    best_candidate given bounds of the candidates for spend, with or
+    without limits. The bounds of the candidates no spend limit binds for
+    are their scores; the others are bounded with limits and scored best
+    bound first, block at a time, while their bounds can still beat or tie
+    the best score.
+    '''
+    binds = table.binding(spend)
+    scores = np.where(binds, -np.inf, bounds)
+    best = int(np.argmax(scores))
+    max_cb = float(scores[best])
+    if max_cb <= 0:
+        best, max_cb = None, 0.0
+    left = np.flatnonzero(binds & (bounds >= max_cb) & (bounds > 0))
+    if not left.size:
+        return best, max_cb
+    tight = table.bounds_of(left, spend, attr, bounds)
+    keep = (tight >= max_cb) & (tight > 0)
+    order = np.argsort(-tight[keep], kind='stable')
+    left, tight = left[keep][order], tight[keep][order]
+    for start in range(0, len(left), block):
+        if tight[start] < max_cb:
+            break
+        candidates = left[start:start + block]
+        scores = table.scores_of(candidates, spend, attr, bounds)
+        for i, temp_cb in zip(candidates, scores):
+            if temp_cb > max_cb or (temp_cb == max_cb and best is not None
+                                    and i < best):
+                best, max_cb = int(i), float(temp_cb)
+    return best, max_cb
@@ -0,0 +1,115 @@
+'''
+Bounded pool for cash back calculations. Web requests hand their
+calculation to a fixed number of threads and wait for it up to a
+deadline, so a burst of expensive submissions queues here instead of
+holding every web worker, and a full queue is refused right away instead
+of growing without bound. A calculation that misses its deadline keeps
+running, so its result can still be cached, while the request is answered
+with a cheaper fallback.
+'''
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+
+class PoolFull(Exception):
+    '''Raised when the queue of a CalculationPool is full'''
+
+
+class CalculationPool:
+    '''
+    At most workers calculations run at once and at most queue_depth more
+    wait for a thread. run waits deadline seconds for a result before
+    answering with the fallback. Counts submissions, rejections, missed
+    deadlines and the time calculations waited in the queue.
+    '''
+
+    def __init__(self, workers=4, queue_depth=16, deadline=5.0):
+        self.workers, self.queue_depth = workers, queue_depth
+        self.deadline = deadline
+        self.submitted, self.completed, self.rejected = 0, 0, 0
+        self.deadline_misses, self.failures = 0, 0
+        self.queued, self.running = 0, 0
+        self.wait_seconds, self.max_wait_seconds = 0.0, 0.0
+        self._lock = threading.Lock()
+        self._executor, self._pid = None, None
+
+    def configure(self, workers=None, queue_depth=None, deadline=None):
+        '''Changes the limits, the threads are restarted on next use'''
+        with self._lock:
+            if workers is not None and workers != self.workers:
+                self.workers = workers
+                if self._executor is not None:
+                    self._executor.shutdown(wait=False)
+                    self._executor = None
+            if queue_depth is not None:
+                self.queue_depth = queue_depth
+            if deadline is not None:
+                self.deadline = deadline
+
+    def run(self, task, fallback, deadline=None):
+        '''
+        Result of task(), or of fallback() if task takes longer than the
+        deadline (the pool's unless given), and whether it came from the
+        fallback. Raises PoolFull when queue_depth calculations already
+        wait for a thread.
+        '''
+        with self._lock:
+            if self._pid != os.getpid():
+                # threads do not survive a fork, e.g. after a warmup in
+                # the parent of prefork workers, so every process starts
+                # its own
+                self._executor, self._pid = None, os.getpid()
+                self.queued, self.running = 0, 0
+            if self.queued >= self.queue_depth + max(
+                    self.workers - self.running, 0):
+                self.rejected += 1
+                raise PoolFull()
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    self.workers, thread_name_prefix='calculation')
+            self.queued += 1
+            self.submitted += 1
+            executor = self._executor
+        future = executor.submit(self._call, task, time.monotonic())
+        try:
+            return future.result(timeout=self.deadline if deadline is None
+                                 else deadline), False
+        except TimeoutError:
+            with self._lock:
+                self.deadline_misses += 1
+            return fallback(), True
+
+    def stats(self):
+        '''Counters and state of the pool as a dictionary'''
+        with self._lock:
+            return {'workers': self.workers,
+                    'queue_depth': self.queue_depth,
+                    'queued': self.queued, 'running': self.running,
+                    'submitted': self.submitted,
+                    'completed': self.completed, 'failures': self.failures,
+                    'rejected': self.rejected,
+                    'deadline_misses': self.deadline_misses,
+                    'wait_seconds': self.wait_seconds,
+                    'max_wait_seconds': self.max_wait_seconds}
+
+    def _call(self, task, submitted):
+        waited = time.monotonic() - submitted
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+            self.wait_seconds += waited
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+        try:
+            result = task()
+        except Exception:
+            with self._lock:
+                self.failures += 1
+            raise
+        finally:
+            with self._lock:
+                self.running -= 1
+        with self._lock:
+            self.completed += 1
+        return result
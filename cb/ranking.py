@@ -0,0 +1,79 @@
+'''
+Ranked runner-up combinations. Keeps the N best distinct combinations of
+a search in a fixed-size min-heap, so memory stays O(N) however many
+candidates are scored, and exposes the N-th score as a threshold the
+search can prune with.
+'''
+import heapq
+from itertools import count
+import numpy as np
+from cb.engine import combo_values
+
+
+class TopCombos:
+    '''
+    The n best combinations offered so far, at most one per key. Scores
+    must be positive. key(combo, score) names what makes a combination
+    distinct; combinations sharing a key keep the best score, and the first
+    one offered among equal scores.
+    '''
+
+    def __init__(self, n, key=frozenset):
+        if n < 1:
+            raise ValueError('n must be at least 1')
+        self.n, self.key = n, key
+        self._heap = []  # (score, -order, key, combo), worst on top
+        self._scores = {}  # key -> score
+        self._order = count()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def threshold(self):
+        '''Score a combination has to beat to enter, 0 until n are kept'''
+        return self._heap[0][0] if len(self._heap) == self.n else 0.0
+
+    def offer(self, score, combo):
+        '''Adds a combination if it ranks, returns whether it did'''
+        if score <= self.threshold():
+            return False
+        key = self.key(combo, score)
+        known = self._scores.get(key)
+        if known is not None:
+            if score <= known:
+                return False
+            self._heap = [entry for entry in self._heap if entry[2] != key]
+            heapq.heapify(self._heap)
+        self._scores[key] = score
+        heapq.heappush(self._heap, (score, -next(self._order), key,
+                                    tuple(combo)))
+        if len(self._heap) > self.n:
+            del self._scores[heapq.heappop(self._heap)[2]]
+        return True
+
+    def ranked(self):
+        '''(score, combo) pairs, best first'''
+        return [(score, combo) for score, _, _, combo
+                in sorted(self._heap, reverse=True)]
+
+
+def core_key(card_vectors, card_names, spend, attr):
+    '''
+    Key function for TopCombos naming a combination by the cards that add
+    cash back to it, so a combination and the same one with a card that
+    adds nothing rank as one
+    '''
+    spend = np.asarray(spend, dtype=np.float64)
+    costs = card_vectors.card_costs(attr)
+
+    def key(combo, score):
+        combo = list(combo)
+        if len(combo) > 1:
+            rows = np.array([combo[:i] + combo[i + 1:]
+                             for i in range(len(combo))], dtype=np.intp)
+            without = (combo_values(card_vectors, rows, spend)
+                       - costs[rows].sum(axis=1))
+            combo = [card for card, temp_cb in zip(combo, without)
+                     if temp_cb < score - 1e-9]
+        return frozenset(card_names[card] for card in combo)
+    return key
@@ -0,0 +1,95 @@
+'''
+Bounded memo of cash back results. Many /cashback submissions repeat the
+same spend profile, so finished calculations are kept in a least recently
+used cache with a time to live, keyed on the normalized inputs.
+'''
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+
+def result_key(spend, attr, num_cards, boa_multiplier, all_counts=False):
+    '''
+    Hashable key of a calculation: the spend array rounded to cents,
+    the membership flags, number of cards, BOA multiplier and whether every
+    number of cards was compared.
+    '''
+    return (tuple(np.round(np.asarray(spend, dtype=np.float64), 2).tolist()),
+            tuple((key, bool(attr[key])) for key in sorted(attr)),
+            int(num_cards), float(boa_multiplier), bool(all_counts))
+
+
+class ResultCache:
+    '''
+    Least recently used cache of result dictionaries. Entries expire after
+    ttl seconds, and the whole cache is dropped when the catalog version
+    changes so results never outlive the card data they came from.
+    '''
+
+    def __init__(self, maxsize=1024, ttl=24 * 3600):
+        self.maxsize, self.ttl = maxsize, ttl
+        self.hits, self.misses = 0, 0
+        self.evictions, self.expirations, self.invalidations = 0, 0, 0
+        self._version = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def configure(self, maxsize=None, ttl=None):
+        '''Changes the size or time to live, evicting entries if needed'''
+        with self._lock:
+            if maxsize is not None:
+                self.maxsize = maxsize
+            if ttl is not None:
+                self.ttl = ttl
+            self._evict()
+
+    def get(self, key, version):
+        '''Cached result for key, or None. Returns a copy of the result'''
+        with self._lock:
+            self._check_version(version)
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return dict(entry[1])
+
+    def set(self, key, version, result):
+        '''Stores a result computed with the given catalog version'''
+        with self._lock:
+            self._check_version(version)
+            if self.maxsize <= 0:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, dict(result))
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        '''Counters and size of the cache as a dictionary'''
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+                'size': len(self._entries), 'maxsize': self.maxsize}
+
+    def _check_version(self, version):
+        if version != self._version:
+            if self._entries:
+                self.invalidations += 1
+                self._entries.clear()
+            self._version = version
+
+    def _evict(self):
+        while len(self._entries) > max(self.maxsize, 0):
+            self._entries.popitem(last=False)
+            self.evictions += 1
@@ -0,0 +1,363 @@
+'''
+Exact search for the best combination of more cards than the vectorized
+engine can enumerate. Uses best-first branch and bound over the groups of
+comb_dict (a group is one card, or all choices of a U.S. Bank or BOA
+card), so at most one choice of each card is picked.
+'''
+import heapq
+from itertools import combinations, count, product
+import numpy as np
+from cb.dominance import pruned_names
+from cb.engine import combo_values
+
+
+def rotating_transform(rates, divisors):
+    '''
+    Function from the best fixed rates of a combination to its effective
+    rates once cards with rotating categories (rates, divisors) are added,
+    see effective_rates
+    '''
+    if not len(rates):
+        return lambda best: best
+
+    def transform(best):
+        bonus = np.maximum(rates - best[..., None, :], 0) / divisors[:, None]
+        return best + bonus.max(axis=-2)
+    return transform
+
+
+def slot_bounds(child_rates, later_vectors, later_costs, positive, first,
+                slots, transform):
+    '''
+    Upper bounds on what filling 0 to slots more slots can add to each
+    child, as a (children, slots + 1) array: the sums of the largest
+    single-card gains. Cards overlap in the categories they improve, so a
+    set of cards never gains more than the sum of its cards on their own.
+    first[i] is the first row child i may still add.
+    '''
+    gains = (transform(np.maximum(child_rates[:, None], later_vectors[None]))
+             - transform(child_rates)[:, None]) @ positive - later_costs
+    gains[np.arange(gains.shape[1])[None] < first[:, None]] = 0
+    np.maximum(gains, 0, out=gains)
+    gains.sort(axis=1)
+    top = gains[:, ::-1][:, :slots]
+    bounds = np.zeros((len(gains), slots + 1))
+    np.cumsum(top, axis=1, out=bounds[:, 1:top.shape[1] + 1])
+    bounds[:, top.shape[1] + 1:] = bounds[:, top.shape[1], None]
+    return bounds
+
+
+class Best:
+    '''
+    Best cash back and combination found so far for at most c cards, for
+    every c up to max_cards. Only the counts in targets prune the search.
+    With a TopCombos top, every improving combination is ranked in it as
+    well and its threshold prunes the search instead.
+    '''
+
+    def __init__(self, max_cards, targets, top=None):
+        self.cb = np.zeros(max_cards + 1)
+        self.combos = [None] * (max_cards + 1)
+        self.targets = np.array(sorted(targets), dtype=np.intp)
+        self.top = top
+        if top is not None and len(self.targets) != 1:
+            raise ValueError('Ranking needs a single number of cards')
+
+    def offer(self, temp_cb, combo):
+        '''Records a combination for every count it fits and beats'''
+        better = np.flatnonzero(self.cb[len(combo):] < temp_cb) + len(combo)
+        self.cb[better] = temp_cb
+        for c in better:
+            self.combos[c] = combo
+        if self.top is not None:
+            self.top.offer(temp_cb, combo)
+
+    def floor(self, counts):
+        '''Cash back a combination of each count has to beat'''
+        if self.top is None:
+            return self.cb[counts]
+        return np.full(np.shape(counts), self.top.threshold())
+
+    def useful(self, bounds, size):
+        '''
+        Which nodes of size cards can still beat a target count, for an
+        (nodes, r) array of bounds on their subtrees with 1 to r more cards
+        '''
+        if len(self.targets) == 1:
+            target = self.targets[0]
+            r = min(target - size, bounds.shape[1]) - 1
+            return bounds[:, r] > self.floor(target) if r >= 0 \
+                else np.zeros(len(bounds), dtype=bool)
+        targets = self.targets[self.targets > size]
+        r = np.minimum(targets - size, bounds.shape[1]) - 1
+        return (bounds[:, r] > self.floor(targets)).any(axis=1)
+
+
+class Caps:
+    '''
+    Spend limits of the rows of a catalog for one spend array, for search.
+    As in CapBound, a category earns at most U * spend plus
+    limit * max(rate - U, 0) over the capped rows of a combination, U being
+    the best rate of its rows without a limit there, and a card with
+    rotating categories adds at most its rate on the spend it can take,
+    divided by its divisor. binds tells the rows one of whose limits binds
+    at spend; combinations without such a row earn their cash back without
+    limits.
+    '''
+
+    def __init__(self, card_vectors, spend):
+        self.card_vectors, self.spend = card_vectors, spend
+        rates, limits = card_vectors.rates, card_vectors.limits
+        positive = np.maximum(spend, 0)
+        capped = np.isfinite(limits) & (rates > 0)
+        self.rates = np.where(capped, rates, 0)
+        self.limits = np.where(capped, limits, 0)
+        self.unlimited = np.where(capped, 0, np.maximum(rates, 0))
+        self.binds = (capped & (positive > limits)).any(axis=1)
+        self.taken = np.minimum(limits, positive)
+
+    def values(self, combos):
+        '''Capped cash back of a list of combinations before costs'''
+        return combo_values(self.card_vectors, combos, self.spend)
+
+    def excess(self, rows, unlimited):
+        '''
+        limit * max(rate - unlimited, 0) of rows, (..., rows, categories)
+        for (..., categories) unlimited
+        '''
+        return self.limits[rows] * np.maximum(
+            self.rates[rows] - unlimited[..., None, :], 0)
+
+    def bonus(self, picked):
+        '''Bound of the rotating category bonus of the picked rows'''
+        picked = np.asarray(picked, dtype=np.intp)
+        if not picked.size:
+            return np.zeros(self.rates.shape[1])
+        divisors = self.card_vectors.divisors[picked]
+        rates = np.maximum(self.card_vectors.rates[picked], 0)
+        return (rates * self.taken[picked] / divisors[:, None]).max(axis=0)
+
+
+def search(groups, vectors, costs, spend, slots, transform, tight, best,
+           picked=(), base_cost=0.0, base_cb=0.0, caps=None):
+    '''
+    Best-first branch and bound over up to slots rows of groups, at most
+    one per group, next to the rows picked, scored as
+    transform(best rates) @ spend - costs - base_cost. Offers every
+    combination that improves on best; when ranking, every combination
+    that beats the threshold and the combination it extends, starting
+    from the picked rows alone earning base_cb. tight tells whether
+    slot_bounds holds for transform.
+
+    With spend limits (caps, see Caps) the score without limits still
+    bounds every subtree, and so does, per category, the bound of Caps
+    over the rows chosen so far and every row of a later group. Only the
+    combinations holding a row whose limit binds, and that could be
+    offered or, when ranking, expanded, are scored exactly.
+    '''
+    # Strong groups first, so good combinations are found early and the
+    # bounds of later groups are tight
+    groups = sorted(groups, key=lambda rows: -np.max(
+        transform(vectors[rows]) @ spend - costs[rows]))
+    rows = np.concatenate(groups)
+    group_of = np.repeat(np.arange(len(groups)), [len(g) for g in groups])
+    first_row = np.searchsorted(group_of, np.arange(len(groups) + 1))
+    # suffix[g] is the best rate of every category in groups g and after
+    suffix = np.full((len(groups) + 1, vectors.shape[1]), -np.inf)
+    for g in range(len(groups) - 1, -1, -1):
+        suffix[g] = np.maximum(suffix[g + 1], vectors[groups[g]].max(axis=0))
+    positive, negative = np.maximum(spend, 0), np.minimum(spend, 0)
+    row_vectors, row_costs = vectors[rows], costs[rows]
+
+    unlimited, binds = np.zeros(vectors.shape[1]), False
+    if caps is not None and not (caps.binds[rows].any()
+                                 or caps.binds[list(picked)].any()):
+        caps = None  # without a binding limit nothing earns less
+    if caps is not None:
+        bonus = caps.bonus(picked)
+        binds = bool(caps.binds[list(picked)].any())
+        # the best unlimited rate of groups g and after, and the most r of
+        # those groups can add above it, excess_top[g, r]
+        unlimited_suffix = np.zeros((len(groups) + 1, vectors.shape[1]))
+        unlimited_suffix[:-1] = np.maximum.accumulate(np.maximum.reduceat(
+            caps.unlimited[rows], first_row[:-1])[::-1])[::-1]
+        later = caps.excess(rows, unlimited_suffix[:-1])
+        later[group_of[None] < np.arange(len(groups))[:, None]] = 0
+        later = -np.sort(-np.maximum.reduceat(later, first_row[:-1], axis=1),
+                         axis=1)[:, :slots]
+        excess_top = np.zeros((len(groups) + 1, slots + 1, vectors.shape[1]))
+        np.cumsum(later, axis=1, out=excess_top[:-1, 1:later.shape[1] + 1])
+        excess_top[:-1, later.shape[1] + 1:] = excess_top[
+            :-1, later.shape[1], None]
+
+    # with one target count the order of the heap already prunes it all
+    multiple = len(best.targets) > 1
+    tiebreak = count()
+    heap = [(-np.inf, next(tiebreak), np.full(slots, np.inf),
+             np.full(vectors.shape[1], -np.inf), base_cost, tuple(picked), 0,
+             base_cb, unlimited, binds)]
+    while heap:
+        bound, _, bounds, current, cost, combo, g, node_cb, unlimited, binds \
+            = heapq.heappop(heap)
+        if -bound <= best.floor(best.targets[0]):
+            break  # no remaining node can beat any target count
+        if multiple and not best.useful(bounds[None], len(combo))[0]:
+            continue  # the best combinations improved since it was pushed
+        # Every child adds one card from group g or a later group
+        start = first_row[g]
+        if start == len(rows):
+            continue  # bounds of capped nodes can keep them without children
+        child_rates = np.maximum(current, row_vectors[start:])
+        child_costs = cost + row_costs[start:]
+        effective = transform(child_rates)
+        child_cb = effective @ spend - child_costs
+        left = slots - (len(combo) - len(picked)) - 1
+        next_group = group_of[start:] + 1
+        if left:
+            # bounds[:, r] bounds each child with r more cards
+            upper = transform(np.maximum(child_rates, suffix[next_group]))
+            bounds = (effective @ negative - child_costs)[:, None]
+            if caps is None:
+                bounds = (bounds + (upper @ positive)[:, None]).repeat(
+                    left, axis=1)
+        scores = child_cb
+        if caps is not None:
+            child_rows = rows[start:]
+            child_unlimited = np.maximum(unlimited,
+                                         caps.unlimited[child_rows])
+            own = caps.excess(child_rows[:, None], child_unlimited)[:, 0]
+            if len(combo) > len(picked):
+                own += caps.excess(np.array(combo[len(picked):]),
+                                   child_unlimited).sum(axis=1)
+            child_binds = binds | caps.binds[child_rows]
+            own_bound = (np.minimum(
+                effective * positive,
+                child_unlimited * positive + own + bonus).sum(axis=1)
+                + effective @ negative - child_costs)
+            if left:
+                # r more cards add the excess of at most r later groups
+                capped = (np.maximum(child_unlimited,
+                                     unlimited_suffix[next_group]) * positive
+                          + own + bonus)[:, None] \
+                    + excess_top[next_group, 1:left + 1]
+                bounds = bounds + np.minimum((upper * positive)[:, None],
+                                             capped).sum(axis=2)
+            scores = np.where(child_binds, own_bound, child_cb)
+            wanted = child_binds & (own_bound > best.floor(len(combo) + 1))
+        if left and tight:
+            bounds = np.minimum(bounds, child_cb[:, None] + slot_bounds(
+                child_rates, row_vectors[start:], row_costs[start:],
+                positive, first_row[next_group] - start, left,
+                transform)[:, 1:])
+        if caps is not None:
+            if best.top is not None and left:
+                # when ranking, expanded children also need their own cash
+                # back to tell whether their children improve on them
+                wanted |= child_binds & best.useful(bounds, len(combo) + 1)
+            scored = np.flatnonzero(wanted)
+            if scored.size:
+                scores[scored] = caps.values(
+                    [combo + (rows[start + i],) for i in scored]
+                ) - child_costs[scored]
+        if best.top is None:
+            i = int(np.argmax(scores))  # children all have the same size
+            if scores[i] > best.cb[len(combo) + 1]:
+                best.offer(float(scores[i]), combo + (rows[start + i],))
+        else:
+            for i in np.flatnonzero((scores > node_cb) & (
+                    scores > best.floor(len(combo) + 1))):
+                best.offer(float(scores[i]), combo + (rows[start + i],))
+        if not left:
+            continue
+        for i in np.flatnonzero(best.useful(bounds, len(combo) + 1)):
+            heapq.heappush(heap, (
+                -bounds[i, -1], next(tiebreak), bounds[i], child_rates[i],
+                child_costs[i], combo + (rows[start + i],), next_group[i],
+                scores[i],
+                None if caps is None else child_unlimited[i],
+                caps is not None and bool(child_binds[i])))
+
+
+def branch_and_bound(comb_dict, num_cards, card_vectors, spend, attr,
+                     prune=False):
+    '''
+    Provably optimal combination of at most num_cards cards. A card is only
+    added when it strictly increases cash back, so fewer cards may be
+    returned.
+
+    Returns the cash back and combination (row indices), or (0, None) when
+    no combination earns positive cash back.
+    '''
+    return branch_and_bound_all(comb_dict, num_cards, card_vectors, spend,
+                                attr, [num_cards], prune=prune)[num_cards]
+
+
+def branch_and_bound_all(comb_dict, max_cards, card_vectors, spend, attr,
+                         targets=None, seeds=(), top=None, prune=False):
+    '''
+    Provably optimal combinations of at most c cards for every c in
+    targets (all counts up to max_cards by default), in one search shared
+    by all counts. seeds are known (cash back, combination) pairs, e.g. the
+    optima for fewer cards, used to prune from the start. With a
+    TopCombos top and a single target, also ranks the best combinations of
+    at most that many cards in top, each card improving on the ones before.
+    With prune, dominated cards (see dominance.py) are not searched; the
+    optima stay the same, as a dominated card can always be swapped for
+    its dominator or dropped.
+
+    Cards with rotating categories do not combine by taking the best rate,
+    so every set of them is tried in turn and the other cards are searched
+    with their bonus applied. Nodes are expanded best bound first. The
+    bound of a node takes, in every category with positive spend, the best
+    rate of the cards chosen so far or of any card in a later group, and
+    ignores the fees of cards still to be added. It is tightened by
+    slot_bounds for every number of cards left. Subtrees whose bounds can
+    not beat the best combinations found so far are pruned. With spend
+    limits a card earns its rate only up to its limit, so in every
+    category where a limit binds the bound is also capped (see Caps), and
+    only the combinations holding such a card are scored exactly.
+
+    Returns a list indexed by card count of (cash back, combination), with
+    (0, None) when no combination earns positive cash back.
+    '''
+    vectors, divisors = card_vectors.rates, card_vectors.divisors
+    spend = np.asarray(spend, dtype=np.float64)
+    costs = card_vectors.card_costs(attr)
+    skipped = pruned_names(card_vectors) if prune else ()
+    names = sorted(set(comb_dict) - set(skipped))
+    groups = [np.array(comb_dict[name], dtype=np.intp) for name in names]
+    rotating = [rows for rows in groups if (divisors[rows] > 0).any()]
+    fixed = [rows for rows in groups if not (divisors[rows] > 0).any()]
+
+    caps = Caps(card_vectors, spend) if card_vectors.capped else None
+
+    best = Best(max_cards, range(1, max_cards + 1) if targets is None
+                else targets, top)
+    for temp_cb, combo in seeds:
+        if combo is not None and len(combo) <= max_cards:
+            best.offer(temp_cb, tuple(combo))
+    for size in range(min(len(rotating), max_cards) + 1):
+        for picked in (rows for comb in combinations(rotating, size)
+                       for rows in product(*comb)):
+            picked = np.array(picked, dtype=np.intp)
+            base_cost, base_cb = costs[picked].sum(), 0.0
+            if size:
+                base_cb = combo_values(card_vectors, picked[None],
+                                       spend)[0] - base_cost
+                best.offer(base_cb, tuple(picked))
+            if size == max_cards or not fixed:
+                continue
+            search(fixed, vectors, costs, spend, max_cards - size,
+                   rotating_transform(vectors[picked], divisors[picked]),
+                   size <= 1, best, tuple(picked), base_cost, base_cb, caps)
+
+    return [(0, None) if combo is None else
+            (float(temp_cb), in_catalog_order(comb_dict, combo))
+            for temp_cb, combo in zip(best.cb, best.combos)]
+
+
+def in_catalog_order(comb_dict, combo):
+    '''Rows of a combination in the order calc_cb enumerates cards'''
+    order = {row: i for i, name in enumerate(sorted(comb_dict))
+             for row in comb_dict[name]}
+    return tuple(sorted((int(row) for row in combo), key=order.get))
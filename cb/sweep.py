@@ -0,0 +1,258 @@
+'''
+What-if sweeps of one spend category. For a fixed combination, cash back
+is linear in the spend of a category between the spend limits of its
+cards there, so between those kinks the best cash back over a range of
+that spend is the upper envelope of one line per combination: convex and
+piecewise linear. The range is split at every sum of limits a
+combination can reach, and in each part the envelope is traced from the
+optima at its ends by intersecting their lines and only solving again
+where the intersection is beaten, which needs about two solves per
+breakpoint instead of one per sample point.
+'''
+import numpy as np
+from cb.batch import parse_profile
+from cb.cashback import calc_cb, recommend_membership, selected_categories
+from cb.engine import combo_values
+from cb.search import branch_and_bound_all
+
+# Most sample points a sweep request can ask for
+MAX_STEPS = 1000
+
+# Highest monthly spend a sweep can reach
+MAX_SPEND = 1000000
+
+# Relative tolerance deciding whether two lines meet the envelope
+TOLERANCE = 1e-9
+
+
+class Line:
+    '''
+    Cash back c + rate * s of a combination when the swept category has
+    spend s, in a range without kinks, combo None for the zero line of no
+    combination
+    '''
+    __slots__ = ('c', 'rate', 'combo')
+
+    def __init__(self, c, rate, combo):
+        self.c, self.rate, self.combo = c, rate, combo
+
+    def __call__(self, s):
+        return self.c + self.rate * s
+
+    def same(self, other):
+        return (_close(self.c, other.c) and _close(self.rate, other.rate))
+
+
+def _close(a, b):
+    return abs(a - b) <= TOLERANCE * max(1.0, abs(a), abs(b))
+
+
+def cap_kinks(comb_dict, num_cards, card_vectors, category, start, stop):
+    '''
+    Spend of a category strictly between start and stop where the cash back
+    of a combination of num_cards cards can bend: the sums of the spend
+    limits there of at most num_cards different cards, in order
+    '''
+    limits = card_vectors.limits[:, category]
+    # sums[n] holds the sums of the limits of n cards
+    sums = [{0.0}]
+    for rows in comb_dict.values():
+        card = limits[np.array(rows, dtype=np.intp)]
+        card = {float(limit) for limit in card[np.isfinite(card)]}
+        for n in range(min(len(sums), num_cards), 0, -1):
+            if n == len(sums):
+                sums.append(set())
+            sums[n] |= {total + limit for total in sums[n - 1]
+                        for limit in card if total + limit < stop}
+    return sorted(total for totals in sums for total in totals
+                  if start < total < stop)
+
+
+def sweep_category(comb_dict, num_cards, card_vectors, card_names, spend,
+                   attr, category, start, stop):
+    '''
+    Best combination of num_cards cards while the spend of one category
+    (column index of spend) goes from start to stop, the other categories
+    keeping their spend in spend.
+
+    Returns (segments, solves), segments being a list of (start, stop,
+    Line) in order covering the range, one per linear piece of the best
+    cash back, and solves the number of times an optimum was computed.
+    Neighbouring segments meet at the breakpoints, where the best
+    combination or the slope of its cash back changes: a combination
+    staying optimal past a kink (see cap_kinks) only gets a segment on
+    each side when its rate changes there.
+    '''
+    spend = np.array(spend, dtype=np.float64)
+    costs = card_vectors.card_costs(attr)
+    solves = 0
+
+    def line_of(combo, a, b):
+        '''Line of a combination over a range a to b without kinks'''
+        if combo is None:
+            return Line(0.0, 0.0, None)
+        if b == a:
+            b = a + 1  # the rate just above a
+        at = np.tile(spend, (2, 1))
+        at[:, category] = a, b
+        values = [combo_values(card_vectors, [combo], s)[0] for s in at]
+        rate = (values[1] - values[0]) / (b - a)
+        c = values[0] - rate * a - costs[list(combo)].sum()
+        return Line(float(c), float(rate), tuple(combo))
+
+    def solve(s, a, b, known=()):
+        '''
+        Optimal line at s, measured over a to b, seeded with lines known to
+        be feasible
+        '''
+        nonlocal solves
+        solves += 1
+        at_s = spend.copy()
+        at_s[category] = s
+        if num_cards > 3:
+            seeds = [(line(s), line.combo) for line in known]
+            temp_cb, combo = branch_and_bound_all(
+                comb_dict, num_cards, card_vectors, at_s, attr, [num_cards],
+                seeds, prune=True)[num_cards]
+        else:
+            temp_cb, combo, _, _ = calc_cb(comb_dict, num_cards, card_vectors,
+                                           card_names, at_s, attr)
+        return line_of(combo if temp_cb > 0 else None, a, b)
+
+    edges = [start, *cap_kinks(comb_dict, num_cards, card_vectors, category,
+                               start, stop), stop]
+    segments, first = [], None
+    for a, b in zip(edges, edges[1:]):
+        # the optimum at a kink is the one the part before it ends with
+        first = (solve(a, a, b) if first is None
+                 else line_of(first.combo, a, b))
+        last = first if b == a else solve(b, a, b, [first])
+        # (s, line) where line becomes optimal, in order of s
+        pieces = [(a, first)]
+        pending = [(a, first, b, last)]
+        while pending:
+            left_end, left, right_end, right = pending.pop()
+            if left.same(right):
+                continue
+            if right.rate == left.rate:
+                # parallel lines never cross, the higher one is optimal
+                if right.c > left.c:
+                    pieces.append((left_end, right))
+                continue
+            # both lines are optimal at one end, so if nothing beats them
+            # where they cross, the envelope is their maximum in between
+            x = (left.c - right.c) / (right.rate - left.rate)
+            x = min(max(x, left_end), right_end)
+            middle = solve(x, a, b, [left, right])
+            if middle(x) <= left(x) + TOLERANCE * max(1.0, abs(left(x))):
+                pieces.append((x, right))
+            else:  # left part first, pending is a stack
+                pending.append((x, middle, right_end, right))
+                pending.append((left_end, left, x, middle))
+        segments += [(s, next_s, line) for (s, line), (next_s, _)
+                     in zip(pieces, pieces[1:] + [(b, None)])]
+        first = last
+
+    # lines crossing at an end of a range leave empty segments, and a
+    # combination whose line a kink leaves unchanged one segment per side
+    merged = []
+    for segment in segments:
+        if segment[1] <= segment[0] and merged:
+            continue
+        if (merged and merged[-1][2].combo == segment[2].combo
+                and merged[-1][2].same(segment[2])):
+            merged[-1] = (merged[-1][0], segment[1], merged[-1][2])
+        elif merged and merged[-1][1] <= merged[-1][0]:
+            merged[-1] = segment
+        else:
+            merged.append(segment)
+    return merged, solves
+
+
+def sweep_results(segments, card_vectors, card_names, attr):
+    '''JSON friendly segments of a sweep, with the breakpoints'''
+    results = []
+    for s, next_s, line in segments:
+        combo = list(line.combo) if line.combo is not None else []
+        results.append({
+            'start': float(s), 'stop': float(next_s),
+            'best_combo': [int(card) for card in combo],
+            'cards': [card_names[card] for card in combo],
+            'max_cb': [float(line(s)), float(line(next_s))],
+            'rate': line.rate,
+            'member_rec': recommend_membership(attr, combo, card_vectors)
+            if combo else {},
+            'select_cat': selected_categories(combo, card_vectors,
+                                              card_names)})
+    return {'segments': results,
+            'breakpoints': [segment['start'] for segment in results[1:]]}
+
+
+def sample(segments, points):
+    '''Best cash back at each spend in points, read off the segments'''
+    values = []
+    for s in points:
+        for start, stop, line in segments:
+            if start <= s <= stop:
+                values.append(float(line(s)))
+                break
+        else:
+            raise ValueError(f'{s} is outside of the swept range')
+    return values
+
+
+def parse_sweep(item, categories):
+    '''
+    Validates a sweep request, a batch profile (see cb/batch.py) with
+        "category": spend category name or column index
+        "start", "stop": range of its monthly spend
+        "steps": optional number of evenly spaced sample points
+    and returns (spend, attr, num_cards, boa_multiplier, category, start,
+    stop, steps). Raises ValueError with a message for the caller.
+    '''
+    spend, attr, num_cards, mult, _ = parse_profile(item, len(categories))
+    category = item.get('category')
+    if category in categories:
+        category = categories.index(category)
+    if (not isinstance(category, int) or isinstance(category, bool)
+            or not 0 <= category < len(categories)):
+        raise ValueError('category must be a spend category name or index')
+
+    bounds = [item.get('start', 0), item.get('stop')]
+    if not all(isinstance(value, (int, float))
+               and not isinstance(value, bool) and np.isfinite(value)
+               for value in bounds):
+        raise ValueError('start and stop must be numbers')
+    start, stop = (float(value) for value in bounds)
+    if not 0 <= start <= stop <= MAX_SPEND:
+        raise ValueError('start and stop must satisfy 0 <= start <= stop '
+                         f'<= {MAX_SPEND}')
+
+    steps = item.get('steps') or 0
+    if (not isinstance(steps, int) or isinstance(steps, bool)
+            or not 0 <= steps <= MAX_STEPS):
+        raise ValueError(f'steps must be an integer from 0 to {MAX_STEPS}')
+    return spend, attr, num_cards, mult, category, start, stop, steps
+
+
+def run_sweep(item, catalog):
+    '''
+    Answers a sweep request against a CatalogCache: the segments and
+    breakpoints of sweep_results, and the best cash back at the sample
+    points when steps were asked for
+    '''
+    categories = list(catalog.get(1)[1].categories)
+    spend, attr, num_cards, mult, category, start, stop, steps = \
+        parse_sweep(item, categories)
+    comb_dict, card_vectors, card_names = catalog.get(mult)
+    segments, solves = sweep_category(comb_dict, num_cards, card_vectors,
+                                      card_names, spend, attr, category,
+                                      start, stop)
+    result = {'category': categories[category], 'solves': solves,
+              **sweep_results(segments, card_vectors, card_names, attr)}
+    if steps:
+        points = np.linspace(start, stop, steps)
+        result['samples'] = [{'spend': float(s), 'max_cb': value}
+                             for s, value in zip(points,
+                                                 sample(segments, points))]
+    return result
@@ -1,85 +1,261 @@
 '''
 Main flask script for website. Includes routes for all
-webpages and runs the app itself.
+webpages and runs the app itself. create_app builds the app; serve.py
+is the production entry point, while app keeps flaskblog:app and
+flask run working.
 
 Made by Michael Wang, 2020
 '''
 
-from flask import Flask, render_template
-from forms import CreditCardForm
+import json
+import logging
+import re
+import time
+from flask import (Flask, Response, current_app, jsonify, render_template,
+                   request)
+from forms import CreditCardForm, calc_pool, catalog, result_cache
+from cb.pool import PoolFull
+from cb.batch import parse_batch, score_profiles, searched
+from cb.dominance import dominance_report
+from cb.sweep import run_sweep
+import assets
+import metrics
+from page_cache import PageCache
 from static.cc_urls import *
 
-app = Flask(__name__)
-
-app.config['SECRET_KEY'] = '1781a2dc5ae8f2ad5e941dbe90d58b8e'
-
-
-@app.route('/')
-@app.route('/index')
+startup_log = logging.getLogger('flaskblog.startup')
+
+# Pages rendered once per deploy, see page_cache.py
+page_cache = PageCache()
+
+# (rule, view, debug, options) of every route, added to the app by
+# create_app
+_routes = []
+
+# Spend profile of the warmup calculation, see warm_up
+WARMUP_FORM = {'total': '3000', 'groceries': '500', 'gas': '150',
+               'restaurants': '300', 'travel': '200', 'utilities': '150',
+               'amazon': '100', 'num_cards': '3'}
+
+
+def route(rule, debug=False, **options):
+    '''
+    Like app.route, for the app create_app builds. debug routes are only
+    added in debug mode or with DEBUG_ROUTES set.
+    '''
+    def decorator(view):
+        _routes.append((rule, view, debug, options))
+        return view
+    return decorator
+
+
+def retry_later(response):
+    '''
+    response as a 503 asking the client to come back after
+    CALC_RETRY_AFTER seconds, for requests shed by calc_pool
+    '''
+    response.status_code = 503
+    response.headers['Retry-After'] = str(
+        current_app.config['CALC_RETRY_AFTER'])
+    return response
+
+
+def create_app(config=None, warm=False):
+    '''
+    Builds the website with its default configuration updated by config.
+    The card catalog is parsed before the first request. With warm, every
+    template is compiled and the pages and a cash back calculation are
+    rendered once too (see warm_up), so processes forked afterwards start
+    with all of it in shared memory.
+    '''
+    start = time.perf_counter()
+    app = Flask(__name__)
+
+    app.config['SECRET_KEY'] = '1781a2dc5ae8f2ad5e941dbe90d58b8e'
+    app.config['CASHBACK_CACHE_SIZE'] = 1024
+    app.config['CASHBACK_CACHE_TTL'] = 24 * 3600
+    app.config['CASHBACK_BATCH_LIMIT'] = 10000
+    # Of which profiles with more than 3 cards, each searched on its own
+    app.config['CASHBACK_BATCH_SEARCH_LIMIT'] = 100
+    # Seconds a batch may take in calc_pool before it is answered with 503
+    app.config['CASHBACK_BATCH_DEADLINE_SECONDS'] = 30.0
+    # Log inputs of requests slower than this many seconds, None to disable
+    app.config['SLOW_REQUEST_SECONDS'] = 2.0
+    # Seconds browsers may reuse a cached page before revalidating its ETag
+    app.config['PAGE_CACHE_MAX_AGE'] = 0
+    # Calculations running at once, waiting for a thread, and the seconds
+    # a request waits before getting an approximate answer instead
+    app.config['CALC_POOL_WORKERS'] = 4
+    app.config['CALC_QUEUE_DEPTH'] = 16
+    app.config['CALC_DEADLINE_SECONDS'] = 5.0
+    # Seconds a client turned away by a full queue is asked to wait
+    app.config['CALC_RETRY_AFTER'] = 5
+    # Serve the /debug pages outside of debug mode too
+    app.config['DEBUG_ROUTES'] = False
+    app.config.update(config or {})
+
+    for rule, view, debug, options in _routes:
+        if debug and not (app.debug or app.config['DEBUG_ROUTES']):
+            continue
+        app.add_url_rule(rule, view_func=view, **options)
+
+    page_cache.init_app(app)
+
+    # Fingerprinted static files, when built with python assets.py
+    assets.init_app(app)
+
+    metrics.init_app(app)
+    metrics.register_stats('flaskblog_catalog', catalog.stats)
+    metrics.register_stats('flaskblog_result_cache', result_cache.stats)
+    metrics.register_stats('flaskblog_page_cache', page_cache.stats)
+    metrics.register_stats('flaskblog_calc_pool', calc_pool.stats)
+
+    result_cache.configure(maxsize=app.config['CASHBACK_CACHE_SIZE'],
+                           ttl=app.config['CASHBACK_CACHE_TTL'])
+    calc_pool.configure(workers=app.config['CALC_POOL_WORKERS'],
+                        queue_depth=app.config['CALC_QUEUE_DEPTH'],
+                        deadline=app.config['CALC_DEADLINE_SECONDS'])
+    timings = {'app': time.perf_counter() - start}
+
+    # Parse the card catalog before serving the first request
+    start = time.perf_counter()
+    catalog.load()
+    timings['catalog'] = time.perf_counter() - start
+
+    if warm:
+        timings.update(warm_up(app))
+    app.extensions['startup'] = timings
+    metrics.register_stats('flaskblog_startup_seconds', lambda: timings)
+    startup_log.info('Started in %.3fs: %s', sum(timings.values()),
+                     ', '.join(f'{phase} {seconds:.3f}s'
+                               for phase, seconds in timings.items()))
+    return app
+
+
+def warm_up(app):
+    '''
+    Imports pandas, compiles every template, including
+    card_descriptions/*.html, renders the cached pages and submits one
+    cash back calculation through the form. Returns the seconds each
+    phase took.
+    '''
+    timings = {}
+    start = time.perf_counter()
+    import pandas  # noqa: F401, used when the catalog is parsed from csv
+    timings['imports'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for name in app.jinja_env.list_templates(extensions=['html']):
+        app.jinja_env.get_template(name)
+    timings['templates'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    client = app.test_client()
+    for rule in app.url_map.iter_rules():
+        view = app.view_functions[rule.endpoint]
+        if getattr(view, '__wrapped__', None) and not rule.arguments:
+            client.get(rule.rule)  # filled into page_cache
+    timings['pages'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    page = client.get('/cashback').get_data(as_text=True)
+    token = re.search(r'name="csrf_token" type="hidden" value="([^"]+)"',
+                      page)
+    response = client.post('/cashback', data={
+        **WARMUP_FORM, 'csrf_token': token.group(1) if token else ''})
+    if (response.status_code != 200
+            or b'per year in cash back' not in response.data):
+        startup_log.warning('Warmup calculation failed with status %s',
+                            response.status_code)
+    timings['warmup'] = time.perf_counter() - start
+    return timings
+
+
+@route('/')
+@route('/index')
+@page_cache.cached
 def index():
     return render_template('index.html')
 
 
-@app.route('/about')
+@route('/about')
+@page_cache.cached
 def about():
     return render_template('about.html', title="About")
 
 
-@app.route('/blog')
+@route('/blog')
+@page_cache.cached
 def blog():
     return render_template('blog.html', title="Blog")
 
 
-@app.route('/resume')
+@route('/resume')
+@page_cache.cached
 def resume():
     return render_template('resume.html', title="Resume")
 
 
-@app.route('/projects')
+@route('/projects')
+@page_cache.cached
 def projects():
     return render_template('index.html', title="Projects")
 
 
-@app.route('/contact')
+@route('/contact')
+@page_cache.cached
 def contact():
     return render_template('contact.html', title="Contact")
 
 
-@app.route('/epidemic/epidemic')
+@route('/epidemic/epidemic')
+@page_cache.cached
 def epidemic():
     return render_template('epidemic.html', title="Epidemic")
 
 
-@app.route('/epidemic/aboutus')
+@route('/epidemic/aboutus')
+@page_cache.cached
 def aboutus():
     return render_template('aboutus.html', title="aboutus")
 
 
-@app.route('/epidemic/demographics')
+@route('/epidemic/demographics')
+@page_cache.cached
 def demographics():
     return render_template('demographics.html', title="demographics")
 
 
-@app.route('/epidemic/contact2')
+@route('/epidemic/contact2')
+@page_cache.cached
 def contact2():
     return render_template('contact2.html', title="contact2")
 
 
-@app.route('/epidemic/policies')
+@route('/epidemic/policies')
+@page_cache.cached
 def policies():
     return render_template('policies.html', title="policies")
 
 
-@app.route('/epidemic/simulator')
+@route('/epidemic/simulator')
+@page_cache.cached
 def simulator():
     return render_template('simulator.html', title="simulator")
 
 
-@app.route('/cashback', methods=['GET', 'POST'])
+@route('/cashback', methods=['GET', 'POST'])
 def cashback():
     form = CreditCardForm()
-    if form.validate_on_submit():
-        results = form.calculate_cb()
+    with metrics.timed('validate'):
+        valid = form.validate_on_submit()
+    if valid:
+        try:
+            results = form.calculate_cb()
+        except PoolFull:
+            return retry_later(Response('The calculator is busy, please '
+                                        'try again in a few seconds.',
+                                        mimetype='text/plain'))
         return render_template('cashback.html', title='Cash Back Calculator',
                                form=form, **results, cc_urls=cc_urls)
     else:
@@ -87,5 +263,83 @@ def cashback():
                                form=form, best_combo=None)
 
 
+@route('/api/cashback/batch', methods=['POST'])
+def cashback_batch():
+    '''
+    Scores a JSON array of spend profiles, or NDJSON with one profile per
+    line, and answers in the same format. See cb/batch.py for the fields.
+    Batches run in calc_pool like /cashback calculations, with a deadline
+    of their own; one that is turned away or misses it is answered with a
+    503.
+    '''
+    ndjson = request.mimetype == 'application/x-ndjson'
+    try:
+        items = parse_batch(request.get_data(as_text=True), ndjson)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    limit = current_app.config['CASHBACK_BATCH_LIMIT']
+    if len(items) > limit:
+        return jsonify(error=f'At most {limit} profiles per request'), 413
+    limit = current_app.config['CASHBACK_BATCH_SEARCH_LIMIT']
+    if sum(map(searched, items)) > limit:
+        return jsonify(error=f'At most {limit} profiles with more than 3 '
+                             'cards per request'), 413
+
+    try:
+        results, late = calc_pool.run(
+            lambda: score_profiles(items, catalog), lambda: None,
+            current_app.config['CASHBACK_BATCH_DEADLINE_SECONDS'])
+    except PoolFull:
+        late = True
+    if late:
+        return retry_later(jsonify(error='The calculator is busy, please '
+                                         'try again in a few seconds.'))
+    if ndjson:
+        return Response(''.join(json.dumps(r) + '\n' for r in results),
+                        mimetype='application/x-ndjson')
+    return jsonify(results=results)
+
+
+@route('/api/cashback/sweep', methods=['POST'])
+def cashback_sweep():
+    '''
+    Best combination and cash back while the spend of one category goes
+    over a range, with the breakpoints where the best combination changes.
+    See cb/sweep.py for the fields. Sweeps run in calc_pool; one that is
+    turned away or misses the deadline is answered with a 503.
+    '''
+    item = request.get_json(silent=True)
+    if item is None:
+        return jsonify(error='Expected a JSON object'), 400
+    try:
+        result, late = calc_pool.run(lambda: run_sweep(item, catalog),
+                                     lambda: None)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    except PoolFull:
+        late = True
+    if late:
+        return retry_later(jsonify(error='The calculator is busy, please '
+                                         'try again in a few seconds.'))
+    return jsonify(result)
+
+
+@route('/debug/dominance', debug=True)
+def debug_dominance():
+    '''Cards every search skips as dominated, by BOA multiplier'''
+    return jsonify({str(tier): dominance_report(catalog.get(tier)[1])
+                    for tier in catalog.tiers})
+
+
+@route('/metrics')
+def prometheus_metrics():
+    return Response(metrics.render(),
+                    mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+
+# App with the default configuration, for flaskblog:app and flask run
+app = create_app()
+
+
 if __name__ == '__main__':
-    app.run(debug=True)
+    create_app({'DEBUG': True}).run()
@@ -9,7 +9,27 @@ import numpy as np
 from flask_wtf import FlaskForm
 from wtforms import DecimalField, IntegerField, SubmitField, BooleanField
 from wtforms.validators import InputRequired, NumberRange, Optional
-from cb.cashback import process_data, calc_cb, calc_stats
+from cb.cashback import (calc_cb, calc_cb_all, calc_cb_top, calc_stats,
+                         get_boa_multiplier, marginal_values)
+from cb.batch import MAX_CARDS
+from cb.catalog import CatalogCache
+from cb.pool import CalculationPool
+from cb.result_cache import ResultCache, result_key
+from metrics import timed
+
+# Other combinations shown below the best one
+RUNNER_UPS = 3
+# Most cards of the approximate answer given when a calculation is late,
+# and of the selections shown with runner-ups, as ranking them takes
+# several times as long as finding the best one
+APPROXIMATE_CARDS = 3
+
+# Processed card data for every BOA tier, shared by all requests
+catalog = CatalogCache(binary='card_catalog.bin')
+# Finished calculations of recently submitted spend profiles
+result_cache = ResultCache()
+# Threads the calculations of all requests share
+calc_pool = CalculationPool()
 
 
 class CreditCardForm(FlaskForm):
@@ -65,6 +85,7 @@ class CreditCardForm(FlaskForm):
                                          NumberRange(min=1, max=8,
                                                      message=prompt)],
                              default=1)
+    all_counts = BooleanField('Compare every number of cards:')
     amazon_member = BooleanField('Amazon Member:')
     costco_member = BooleanField('Costco Member:')
     sams_member = BooleanField("Sam's Club Member:")
@@ -77,20 +98,42 @@ class CreditCardForm(FlaskForm):
     def calculate_cb(self):
         '''
         Calls other methods to calculate cash back and
-        returns all necessary output in a dictionary
+        returns all necessary output in a dictionary.
+        The calculation runs in calc_pool; if it misses the deadline, the
+        best selection of at most APPROXIMATE_CARDS cards is returned with
+        approximate set. Raises PoolFull when the pool is saturated.
         '''
         num_cards = self.num_cards.data
         boa_multiplier = self.get_boa_multiplier()
-        spend, attr = self.get_spend_attr()
-        comb_dict, card_vectors, card_names = process_data(boa_multiplier)
-        max_cb, best_combo, member_rec, select_cat = calc_cb(
-            comb_dict, num_cards, card_vectors, card_names, spend, attr)
-        avg_cb, annual_cb = calc_stats(spend, max_cb)
-        results = {'best_combo': best_combo, 'select_cat': select_cat,
-                   'member_rec': member_rec, 'card_names': card_names,
-                   'mult': boa_multiplier, 'avg_cb': avg_cb,
-                   'annual_cb': annual_cb}
-        return results
+        with timed('get_spend_attr'):
+            spend, attr = self.get_spend_attr()
+        spend = np.round(spend, 2)  # results are cached by the cent
+
+        all_counts = bool(self.all_counts.data)
+        version = catalog.refresh()
+        key = result_key(spend, attr, num_cards, boa_multiplier, all_counts)
+        results = result_cache.get(key, version)
+        if results is not None:
+            return results
+
+        with timed('process_data'):
+            data = catalog.get(boa_multiplier)
+
+        def exact():
+            results = calculate(data, spend, attr, num_cards,
+                                boa_multiplier, all_counts)
+            # also cached when the request already gave up on it
+            result_cache.set(key, version, results)
+            return results
+
+        def approximate():
+            return calculate(data, spend, attr,
+                             min(num_cards, APPROXIMATE_CARDS),
+                             boa_multiplier, False)
+
+        with timed('calc_cb'):
+            results, late = calc_pool.run(exact, approximate)
+        return {**results, 'approximate': late}
 
     def get_boa_multiplier(self):
         '''
@@ -98,16 +141,9 @@ class CreditCardForm(FlaskForm):
         qualifies for a rewards level that increases cash back.
         This function decides the multiplier used in the calculation.
         '''
-        boa_multiplier = 1
         if self.boa_amt.data is None:
             self.boa_amt.data = 0
-        if self.boa_amt.data >= 100000:
-            boa_multiplier = 1.75
-        elif self.boa_amt.data >= 50000:
-            boa_multiplier = 1.5
-        elif self.boa_amt.data >= 20000:
-            boa_multiplier = 1.25
-        return boa_multiplier
+        return get_boa_multiplier(self.boa_amt.data)
 
     def get_spend_attr(self):
         '''
@@ -129,26 +165,9 @@ class CreditCardForm(FlaskForm):
                       self.foreign_transaction.data, self.rideshare.data]
         temp_spend = [0 if v is None else v for v in temp_spend]
 
-        # Take into account caps on categories
-        # groceries
-        temp_spend[0] = min(500, temp_spend[0])
-        # online shopping
-        temp_spend[8] = min(int(2500 / 3), temp_spend[8])
-        # home improvement
-        temp_spend[10] = min(int(2500 / 3), temp_spend[10])
-        # spending doesn't fall into category, includes overflow from capped
-
-        # us bank categories
-        us_bank_data = temp_spend[5:8]
-        min_value = min(us_bank_data)
-        min_index = us_bank_data.index(min_value)
-        us_bank_data[min_index] = 0
-        if sum(us_bank_data) > 500:
-            for i in [0, 1, 2]:
-                if i != min_index:
-                    us_bank_data[i] = 250
-        temp_spend[5:8] = us_bank_data
-
+        # Spend limits of capped categories are applied by the engine,
+        # which routes spend beyond them to the next best card
+        # spending doesn't fall into category
         other = max(total_spend - sum(temp_spend), 0)
         temp_spend.append(other)
         spend = [float(i) for i in temp_spend]
@@ -159,3 +178,43 @@ class CreditCardForm(FlaskForm):
                 'sams_member': self.sams_member.data}
 
         return spend, attr
+
+
+def calculate(data, spend, attr, num_cards, boa_multiplier, all_counts):
+    '''
+    Result dictionary of the cashback page for a spend profile and the
+    (comb_dict, card_vectors, card_names) of its BOA tier. Runner-ups are
+    only ranked up to APPROXIMATE_CARDS cards.
+    '''
+    comb_dict, card_vectors, card_names = data
+    by_count, scored = None, None
+    if all_counts:
+        scored = calc_cb_all(comb_dict, MAX_CARDS, card_vectors, card_names,
+                             spend, attr)
+        by_count = [
+            {'num_cards': count, 'annual_cb': result[0] * 12,
+             'marginal': marginal * 12,
+             'cards': [card_names[card] for card in result[1]]
+             if result[0] > 0 else [],
+             'selected': count == num_cards}
+            for count, (result, marginal) in enumerate(
+                zip(scored, marginal_values(scored)), 1)]
+    max_cb, best_combo, member_rec, select_cat = (
+        scored[num_cards - 1] if scored else calc_cb(
+            comb_dict, num_cards, card_vectors, card_names, spend, attr))
+    ranked = []
+    if num_cards <= APPROXIMATE_CARDS:
+        ranked = calc_cb_top(comb_dict, num_cards, card_vectors, card_names,
+                             spend, attr, RUNNER_UPS + 1)
+    runner_ups = [{'cards': [card_names[card] for card in combo],
+                   'annual_cb': temp_cb * 12, 'member_rec': rec,
+                   'select_cat': cats}
+                  for temp_cb, combo, rec, cats in ranked[1:]]
+    avg_cb, annual_cb = calc_stats(spend, max_cb)
+    return {'best_combo': best_combo, 'select_cat': select_cat,
+            'member_rec': member_rec, 'card_names': card_names,
+            'card_ids': {card: card_vectors.image_id(card)
+                         for card in best_combo},
+            'mult': boa_multiplier, 'avg_cb': avg_cb,
+            'annual_cb': annual_cb, 'by_count': by_count,
+            'runner_ups': runner_ups}
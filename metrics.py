@@ -0,0 +1,166 @@
+'''
+Lightweight request timing for the website. Keeps histograms of request
+durations and of the phases of each request (form validation, spend
+processing, catalog lookup, cash back calculation and template rendering)
+in memory and serves them in the Prometheus text format, so no external
+service is needed. Optionally logs the inputs of slow requests.
+'''
+import json
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from flask import (g, has_request_context, request, before_render_template,
+                   template_rendered)
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+           0.5, 1, 2.5, 5, 10)
+
+slow_log = logging.getLogger('flaskblog.slow_requests')
+
+
+class Histogram:
+    '''Cumulative histogram of observations for each set of label values'''
+
+    def __init__(self, name, help, labelnames, buckets=BUCKETS):
+        self.name, self.help = name, help
+        self.labelnames, self.buckets = tuple(labelnames), tuple(buckets)
+        self._series = {}  # label values -> [bucket counts, sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0, 0]
+            i = bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}',
+                 f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = sorted((key, (list(counts), total, count))
+                            for key, (counts, total, count)
+                            in self._series.items())
+        for key, (counts, total, count) in series:
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bucket, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = _labels(labels + [('le', repr(float(bucket)))])
+                lines.append(f'{self.name}_bucket{le} {cumulative}')
+            lines.append(f'{self.name}_bucket'
+                         f'{_labels(labels + [("le", "+Inf")])} {count}')
+            lines.append(f'{self.name}_sum{_labels(labels)} {total!r}')
+            lines.append(f'{self.name}_count{_labels(labels)} {count}')
+        return lines
+
+
+def _labels(pairs):
+    if not pairs:
+        return ''
+    escaped = (value.replace('\\', r'\\').replace('"', r'\"')
+               .replace('\n', r'\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value
+                          in zip(pairs, escaped)) + '}'
+
+
+REQUESTS = Histogram('flaskblog_request_duration_seconds',
+                     'Time to answer a request',
+                     ('endpoint', 'method', 'status'))
+PHASES = Histogram('flaskblog_phase_duration_seconds',
+                   'Time spent in each phase of a request',
+                   ('endpoint', 'phase'))
+
+# name -> function returning a dictionary of numbers, see register_stats
+_stats = {}
+
+
+def register_stats(name, stats):
+    '''
+    Exposes the numeric values of stats(), e.g. the counters of a cache,
+    as gauges named <name>_<key>
+    '''
+    _stats[name] = stats
+
+
+def observe_phase(phase, elapsed):
+    '''Records the duration of a phase of the current request'''
+    endpoint = request.endpoint if has_request_context() else None
+    PHASES.observe(elapsed, endpoint=endpoint or '', phase=phase)
+    if has_request_context():
+        phases = g.setdefault('phases', {})
+        phases[phase] = phases.get(phase, 0) + elapsed
+
+
+@contextmanager
+def timed(phase):
+    '''Times the enclosed block as a phase of the current request'''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_phase(phase, time.perf_counter() - start)
+
+
+def render():
+    '''All metrics in the Prometheus text exposition format'''
+    lines = REQUESTS.render() + PHASES.render()
+    for name, stats in sorted(_stats.items()):
+        for key, value in sorted(stats().items()):
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                metric = f'{name}_{key}'
+                lines += [f'# TYPE {metric} gauge', f'{metric} {value!r}']
+    return '\n'.join(lines) + '\n'
+
+
+def init_app(app):
+    '''
+    Times every request of app and the rendering of its templates. If
+    SLOW_REQUEST_SECONDS is set in the app config, requests slower than it
+    are logged with their inputs.
+    '''
+    app.config.setdefault('SLOW_REQUEST_SECONDS', None)
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def stop_timer(response):
+        if 'request_start' not in g:
+            return response
+        elapsed = time.perf_counter() - g.request_start
+        REQUESTS.observe(elapsed, endpoint=request.endpoint or '',
+                         method=request.method, status=response.status_code)
+        threshold = app.config['SLOW_REQUEST_SECONDS']
+        if threshold is not None and elapsed > threshold:
+            log_slow_request(elapsed)
+        return response
+
+    def start_render(sender, template, context, **extra):
+        g.render_start = time.perf_counter()
+
+    def stop_render(sender, template, context, **extra):
+        if 'render_start' in g:
+            observe_phase('render', time.perf_counter() - g.pop('render_start'))
+
+    before_render_template.connect(start_render, app, weak=False)
+    template_rendered.connect(stop_render, app, weak=False)
+
+
+def log_slow_request(elapsed):
+    '''Logs the inputs and phase timings of the current request'''
+    form = {key: value for key, value in request.form.items()
+            if key != 'csrf_token'}
+    slow_log.warning('Slow request %s', json.dumps({
+        'method': request.method, 'path': request.path,
+        'seconds': round(elapsed, 4), 'args': request.args.to_dict(),
+        'form': form, 'phases': {phase: round(seconds, 4) for phase, seconds
+                                 in g.get('phases', {}).items()}}))
@@ -0,0 +1,128 @@
+'''
+Full-page cache for the pages of the website whose output only changes
+with a deploy. Each page is rendered once per process and kept as bytes
+together with gzip and, when the brotli package is installed, brotli
+compressed copies. Cache hits answer from those bytes without calling the
+view or Jinja, send a strong ETag per encoding and answer If-None-Match
+with 304 Not Modified. In debug mode, or with TEMPLATES_AUTO_RELOAD,
+pages are rendered again whenever a template changes on disk.
+'''
+import gzip
+import hashlib
+import os
+import threading
+from functools import wraps
+from flask import Response, current_app, request
+
+try:
+    import brotli
+except ImportError:  # pages are served with gzip only
+    brotli = None
+
+
+class Page:
+    '''Rendered bytes of a page and their compressed copies'''
+    __slots__ = ('body', 'variants', 'etags', 'mimetype', 'version')
+
+    def __init__(self, body, mimetype, version):
+        self.body, self.mimetype, self.version = body, mimetype, version
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        # encoding -> bytes, identity first
+        self.variants = {'identity': body,
+                         'gzip': gzip.compress(body, 9, mtime=0)}
+        if brotli is not None:
+            self.variants['br'] = brotli.compress(body)
+        # every encoding is a different representation with its own tag
+        self.etags = {encoding: digest if encoding == 'identity'
+                      else f'{digest}-{encoding}'
+                      for encoding in self.variants}
+
+
+class PageCache:
+    '''
+    Rendered pages by path. Counts hits, misses (renders) and 304
+    answers for monitoring.
+    '''
+
+    def __init__(self):
+        self.hits, self.misses, self.not_modified = 0, 0, 0
+        self._pages = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        '''
+        Reads PAGE_CACHE_MAX_AGE, the seconds browsers may reuse a page
+        before revalidating it (0 by default)
+        '''
+        app.config.setdefault('PAGE_CACHE_MAX_AGE', 0)
+
+    def cached(self, view):
+        '''Decorator serving the pages rendered by view from the cache'''
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            key = (request.script_root, request.path)
+            version = self._template_version()
+            page = self._pages.get(key)
+            if page is None or page.version != version:
+                self.misses += 1
+                rendered = current_app.make_response(view(*args, **kwargs))
+                if rendered.status_code != 200 or rendered.direct_passthrough:
+                    return rendered
+                page = Page(rendered.get_data(), rendered.mimetype, version)
+                with self._lock:
+                    self._pages = {**self._pages, key: page}
+            else:
+                self.hits += 1
+            return self._respond(page)
+        return wrapper
+
+    def clear(self):
+        with self._lock:
+            self._pages = {}
+
+    def stats(self):
+        '''Counters and size of the cache as a dictionary'''
+        return {'hits': self.hits, 'misses': self.misses,
+                'not_modified': self.not_modified, 'pages': len(self._pages),
+                'bytes': sum(len(variant) for page in self._pages.values()
+                             for variant in page.variants.values())}
+
+    def _respond(self, page):
+        encoding = _negotiate(page.variants)
+        etag = page.etags[encoding]
+        if request.if_none_match.contains(etag):
+            self.not_modified += 1
+            response = Response(status=304)
+        else:
+            response = Response(page.variants[encoding],
+                                mimetype=page.mimetype)
+            if encoding != 'identity':
+                response.content_encoding = encoding
+        response.set_etag(etag)
+        response.vary.add('Accept-Encoding')
+        response.cache_control.public = True
+        response.cache_control.max_age = \
+            current_app.config['PAGE_CACHE_MAX_AGE']
+        return response
+
+    def _template_version(self):
+        '''
+        Latest mtime of the templates when they are reloaded on change,
+        None otherwise so pages live until the process restarts
+        '''
+        app = current_app
+        if not (app.debug or app.config.get('TEMPLATES_AUTO_RELOAD')):
+            return None
+        folder = os.path.join(app.root_path, app.template_folder)
+        return max((os.path.getmtime(os.path.join(root, name))
+                    for root, _, names in os.walk(folder) for name in names),
+                   default=None)
+
+
+def _negotiate(variants):
+    '''Best encoding of variants the client accepts, brotli first'''
+    accepted = request.accept_encodings
+    for encoding in ('br', 'gzip'):
+        if encoding in variants and accepted[encoding]:
+            return encoding
+    return 'identity'
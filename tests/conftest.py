@@ -0,0 +1,64 @@
+'''
+Fixtures shared by the tests: the card catalog with and without its
+spend limits, spend profiles and an exhaustive reference for calc_cb.
+Run from the repository root with python -m pytest.
+'''
+import os
+from itertools import combinations, product
+import numpy as np
+import pytest
+from cb.cards import CardCatalog
+from cb.cashback import process_data
+from cb.engine import combo_values
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Membership flags the profiles are scored with, in turn
+ATTRS = ({'amazon_member': False, 'costco_member': False,
+          'sams_member': False},
+         {'amazon_member': True, 'costco_member': True,
+          'sams_member': False})
+
+
+@pytest.fixture(scope='session')
+def capped():
+    '''(comb_dict, card_vectors, card_names) of card_data.csv'''
+    return process_data(1.0, os.path.join(ROOT, 'card_data.csv'))
+
+
+@pytest.fixture(scope='session')
+def uncapped(capped):
+    '''The catalog of capped with every spend limit removed'''
+    comb_dict, card_vectors, card_names = capped
+    return comb_dict, CardCatalog(
+        card_vectors.rates, card_vectors.categories, card_vectors.names,
+        card_vectors.fees, card_vectors.members, card_vectors.divisors,
+        card_vectors.memberships, card_vectors.choices), card_names
+
+
+def spend_profiles(count, seed, categories=17):
+    '''
+    Monthly spend arrays, every other one with its grocery, gas, dining
+    and utilities spend far past the spend limits of those categories
+    '''
+    rng = np.random.default_rng(seed)
+    spend = rng.gamma(0.5, 120, (count, categories)).round(2)
+    spend[::2, [0, 1, 2, 5]] *= 10
+    return spend
+
+
+def brute_force(comb_dict, num_cards, card_vectors, spend, attr):
+    '''
+    Best monthly cash back of at most num_cards cards, at most one row per
+    card, by scoring every combination, 0 when none earns any
+    '''
+    costs = card_vectors.card_costs(attr)
+    best = 0.0
+    for size in range(1, num_cards + 1):
+        rows = np.array([combo for names in combinations(sorted(comb_dict),
+                                                         size)
+                         for combo in product(*(comb_dict[name]
+                                                for name in names))])
+        values = combo_values(card_vectors, rows, spend) - costs[rows].sum(1)
+        best = max(best, float(values.max()))
+    return best
@@ -0,0 +1,110 @@
+'''
+Spend limits: the greedy allocation against trying every split of the
+spend, its cheap bound, and calc_cb with limits against brute force.
+'''
+import numpy as np
+import pytest
+from cb.cashback import calc_cb, calc_cb_all, calc_cb_top, calc_temp_cb
+from cb.engine import Allocation, CapBound, candidate_table, effective_rates
+from conftest import ATTRS, brute_force, spend_profiles
+
+
+def best_split(rates, limits, spend):
+    '''
+    Best cash back of splitting whole dollars of spend over cards, each
+    taking at most its limit, by trying every split
+    '''
+    if not rates:
+        return 0.0
+    return max(rates[0] * x + best_split(rates[1:], limits[1:], spend - x)
+               for x in range(int(min(limits[0], spend)) + 1))
+
+
+def random_cards(rng, count):
+    '''Rates, limits and divisors of count cards in one category'''
+    rates = rng.choice([0.01, 0.02, 0.03, 0.05, 0.06], count)
+    limits = rng.choice([5, 10, 20, np.inf], count)
+    divisors = np.zeros(count)
+    return rates, limits, divisors
+
+
+@pytest.mark.parametrize('rotating', [False, True])
+def test_allocation_matches_every_split(rotating):
+    rng = np.random.default_rng(6)
+    for _ in range(60):
+        rates, limits, divisors = random_cards(rng, rng.integers(1, 4))
+        if rotating:
+            divisors[0] = 4
+        spend = float(rng.integers(0, 41))
+        fixed = divisors == 0
+        expected = best_split(list(rates[fixed]), list(limits[fixed]), spend)
+        if rotating:
+            expected += (best_split(list(rates), list(limits), spend)
+                         - expected) / 4
+        allocation = Allocation(rates[None, :, None], limits[None, :, None],
+                                divisors[None])
+        assert allocation.values(np.array([[spend]]))[0, 0, 0] == \
+            pytest.approx(expected)
+
+
+def test_allocation_without_limits_is_linear(uncapped):
+    comb_dict, card_vectors, card_names = uncapped
+    rows = np.array([[1, 7, 15], [0, 7, 25], [4, 9, 11]])  # with Discover
+    spends = spend_profiles(5, 7) - 50  # some refunds
+    allocation = Allocation(card_vectors.rates[rows],
+                            card_vectors.limits[rows],
+                            card_vectors.divisors[rows])
+    assert allocation.values(spends).sum(axis=-1) == pytest.approx(
+        effective_rates(card_vectors.rates, card_vectors.divisors, rows)
+        @ spends.T)
+
+
+def test_cap_bound_bounds_allocation():
+    rng = np.random.default_rng(8)
+    rates, limits, divisors = [], [], []
+    for _ in range(200):
+        card_rates, card_limits, card_divisors = random_cards(rng, 3)
+        card_divisors[0] = 4 * (rng.random() < 0.3)
+        rates.append(card_rates)
+        limits.append(card_limits)
+        divisors.append(card_divisors)
+    rates, limits = np.array(rates)[..., None], np.array(limits)[..., None]
+    divisors = np.array(divisors)
+    spends = np.arange(0, 61, 3.0)[:, None]
+    exact = Allocation(rates, limits, divisors).values(spends)
+    bound = CapBound(rates, limits, divisors)
+    bounds = bound.values(spends)
+    assert (bounds >= exact - 1e-12).all()
+    below = spends[None, :, :] <= bound.headroom[:, None]
+    assert bounds[below] == pytest.approx(exact[below])
+
+
+@pytest.mark.parametrize('num_cards', [2, 3])
+def test_table_scores_are_capped_values(capped, num_cards):
+    comb_dict, card_vectors, card_names = capped
+    table = candidate_table(comb_dict, card_vectors, num_cards)
+    for spend, attr in zip(spend_profiles(4, 9), ATTRS * 2):
+        scores = table.score(spend, attr)
+        bounds = table.bound(spend, attr)
+        assert (bounds >= scores - 1e-9).all()
+        for i in range(0, len(table), max(1, len(table) // 50)):
+            assert scores[i] == pytest.approx(calc_temp_cb(
+                card_vectors, spend, table.combo(i, spend), num_cards, attr))
+
+
+@pytest.mark.parametrize('num_cards, seed', [(3, 10), (4, 11)])
+def test_calc_cb_with_limits_matches_brute_force(capped, num_cards, seed):
+    comb_dict, card_vectors, card_names = capped
+    for spend, attr in zip(spend_profiles(6, seed), ATTRS * 3):
+        expected = brute_force(comb_dict, num_cards, card_vectors, spend,
+                               attr)
+        max_cb, best_combo, _, _ = calc_cb(comb_dict, num_cards,
+                                           card_vectors, card_names, spend,
+                                           attr)
+        assert max_cb == pytest.approx(expected)
+        assert calc_temp_cb(card_vectors, spend, best_combo, num_cards,
+                            attr) == pytest.approx(max_cb)
+        assert calc_cb_all(comb_dict, num_cards, card_vectors, card_names,
+                           spend, attr)[-1][0] == pytest.approx(expected)
+        assert calc_cb_top(comb_dict, num_cards, card_vectors, card_names,
+                           spend, attr, 2)[0][0] == pytest.approx(expected)
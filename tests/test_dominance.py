@@ -0,0 +1,54 @@
+'''
+Skipping dominated cards must keep the optimum, with and without spend
+limits, for the candidate tables and the search.
+'''
+import numpy as np
+import pytest
+from cb.cards import CardCatalog
+from cb.dominance import pruned_names
+from cb.engine import best_candidate, candidate_table
+from cb.search import branch_and_bound_all
+from conftest import ATTRS, brute_force, spend_profiles
+
+
+@pytest.fixture(params=['capped', 'uncapped'])
+def catalog(request):
+    return request.getfixturevalue(request.param)
+
+
+def test_dominators():
+    # a dominates b and c, the same card with a limit, but c does not
+    # dominate b as it only earns as much up to its limit, nor does d,
+    # paying a fee for its better rates
+    rates = [[0.03, 0.02], [0.02, 0.02], [0.03, 0.02], [0.04, 0.03]]
+    limits = [[np.inf, np.inf], [np.inf, np.inf], [100, np.inf],
+              [np.inf, np.inf]]
+    card_vectors = CardCatalog(rates, ('Grocery', 'Other'), 'abcd',
+                               [0, 0, 0, 5], np.zeros((4, 0)), [0] * 4,
+                               limits=limits)
+    assert card_vectors.dominators == ((), (0,), (0,), ())
+    assert pruned_names(card_vectors) == {'b', 'c'}
+
+
+@pytest.mark.parametrize('num_cards', [1, 2, 3])
+def test_pruned_tables_keep_the_optimum(catalog, num_cards):
+    comb_dict, card_vectors, card_names = catalog
+    tables = [candidate_table(comb_dict, card_vectors, num_cards, prune)
+              for prune in (False, True)]
+    assert len(tables[1]) < len(tables[0])
+    for spend, attr in zip(spend_profiles(8, 4), ATTRS * 4):
+        full, pruned = (best_candidate(table, spend, attr)[1]
+                        for table in tables)
+        assert pruned == pytest.approx(full)
+
+
+def test_pruned_search_keeps_the_optimum(catalog):
+    comb_dict, card_vectors, card_names = catalog
+    for spend, attr in zip(spend_profiles(4, 5), ATTRS * 2):
+        full, pruned = (branch_and_bound_all(comb_dict, 4, card_vectors,
+                                             spend, attr, prune=prune)
+                        for prune in (False, True))
+        assert [cb for cb, _ in pruned] == pytest.approx(
+            [cb for cb, _ in full])
+        assert pruned[-1][0] == pytest.approx(brute_force(
+            comb_dict, 4, card_vectors, spend, attr))
@@ -0,0 +1,37 @@
+'''
+calc_cb against scoring every combination, for the candidate tables of up
+to 3 cards and the branch and bound search beyond, on the catalog without
+spend limits. Discover IT, the card with rotating categories, takes part
+in every search.
+'''
+import pytest
+from cb.cashback import calc_cb, calc_temp_cb
+from cb.engine import candidate_table
+from conftest import ATTRS, brute_force, spend_profiles
+
+
+@pytest.mark.parametrize('num_cards', [1, 2, 3])
+def test_table_scores_are_combination_values(uncapped, num_cards):
+    comb_dict, card_vectors, card_names = uncapped
+    table = candidate_table(comb_dict, card_vectors, num_cards)
+    for spend, attr in zip(spend_profiles(4, 1), ATTRS * 2):
+        scores = table.score(spend, attr)
+        for i in range(0, len(table), max(1, len(table) // 50)):
+            assert scores[i] == pytest.approx(calc_temp_cb(
+                card_vectors, spend, table.combo(i, spend), num_cards, attr))
+
+
+@pytest.mark.parametrize('num_cards, seed', [(3, 2), (4, 3)])
+def test_calc_cb_matches_brute_force(uncapped, num_cards, seed):
+    comb_dict, card_vectors, card_names = uncapped
+    for spend, attr in zip(spend_profiles(6, seed), ATTRS * 3):
+        max_cb, best_combo, _, _ = calc_cb(comb_dict, num_cards,
+                                           card_vectors, card_names, spend,
+                                           attr)
+        assert max_cb == pytest.approx(brute_force(
+            comb_dict, num_cards, card_vectors, spend, attr))
+        assert len(best_combo) <= num_cards
+        if max_cb > 0:
+            assert calc_temp_cb(card_vectors, spend, best_combo, num_cards,
+                                attr) == pytest.approx(max_cb)
+